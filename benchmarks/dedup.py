@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# Copyright 2022, Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Time the duplicate detection of the organization pagination.
+
+The repository pages are synthetic, no request is sent. The last page
+repeats an earlier one, like the never ending next_page token of some Quay
+versions. iter_organization_repositories is compared with the list based
+check it replaced, which is only run up to --legacy-max repositories as it
+is quadratic. One JSON line is written per run, e.g.:
+
+    python benchmarks/dedup.py --sizes 1000,10000,50000
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from quaytool import quaytool  # noqa: E402
+
+ORGANIZATION = "bench"
+PAGE_SIZE = 100
+DEFAULT_SIZES = "1000,10000,50000"
+DEFAULT_LEGACY_MAX = 50000
+
+
+def make_pages(size):
+    repositories = [{"namespace": ORGANIZATION, "name": "repo%06d" % index,
+                     "is_public": False, "kind": "image"}
+                    for index in range(size)]
+    pages = [{"repositories": repositories[start:start + PAGE_SIZE],
+              "next_page": str(start + PAGE_SIZE)}
+             for start in range(0, size, PAGE_SIZE)]
+    pages.append(dict(pages[-1]))
+    return pages
+
+
+def legacy_dedup(pages):
+    """The check of get_organization_details before the set index."""
+    repositories = list(pages[0]['repositories'])
+    for namespace_info in pages[1:]:
+        ns_repos = namespace_info['repositories']
+        if all(repo in repositories for repo in ns_repos):
+            break
+        repositories += ns_repos
+    return repositories
+
+
+def indexed_dedup(pages):
+    quaytool.iter_repo_pages = lambda *args, **kwargs: iter(pages)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        return list(quaytool.iter_organization_repositories(
+            None, None, False, ORGANIZATION, None, None))
+
+
+def measure(implementation, pages, runs):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        repositories = implementation(pages)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(repositories)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help="Comma separated numbers of repositories")
+    parser.add_argument("--legacy-max", type=int, default=DEFAULT_LEGACY_MAX,
+                        help="Largest size timed with the list based check")
+    parser.add_argument("--runs", type=int, default=3,
+                        help="Runs per size, the best one is reported")
+    args = parser.parse_args()
+
+    implementations = {"indexed": indexed_dedup, "legacy": legacy_dedup}
+    for size in [int(size) for size in args.sizes.split(",")]:
+        pages = make_pages(size)
+        for name, implementation in implementations.items():
+            if name == "legacy" and size > args.legacy_max:
+                continue
+            seconds, count = measure(implementation, pages, args.runs)
+            print(json.dumps({"implementation": name, "repositories": size,
+                              "pages": len(pages), "found": count,
+                              "seconds": round(seconds, 4)}))
+
+
+if __name__ == "__main__":
+    main()
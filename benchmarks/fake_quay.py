@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+# Copyright 2022, Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A small in-process fake of the Quay API, for benchmarks.
+
+It only knows the endpoints used by quaytool. Repositories are listed 100
+per page with next_page tokens, like Quay does.
+"""
+
+import argparse
+import collections
+import email.utils
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PAGE_SIZE = 100
+API = "/api/v1"
+
+
+class FakeQuay:
+    def __init__(self, organization="bench", repositories=100, tags=5,
+                 latency=0, error_rate=0, seed=0, page_latency=0):
+        self.organization = organization
+        self.latency = latency
+        self.page_latency = page_latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        # time.monotonic() of the first change and of the last listing page
+        self.first_change = None
+        self.listed = None
+        self.repositories = [{
+            "namespace": organization,
+            "name": "repo%06d" % index,
+            "is_public": False,
+            "kind": "image",
+            "last_modified": 1600000000 + index,
+        } for index in range(repositories)]
+        self.index = {repo['name']: repo for repo in self.repositories}
+        self.tags = {}
+        for repo in self.repositories:
+            self.tags[repo['name']] = [{
+                "name": "tag%s" % tag,
+                "manifest_digest": "sha256:%064x" % (
+                    hash((repo['name'], tag)) & (2 ** 256 - 1)),
+                "size": 1000 * (tag + 1),
+                "start_ts": 1600000000 + tag,
+            } for tag in range(tags)]
+            # a deleted tag, for --restore-tag
+            self.tags[repo['name']].append({
+                "name": "deleted", "manifest_digest": "sha256:%064x" % 1,
+                "size": 10, "start_ts": 1500000000, "end_ts": 1500000001})
+        self.robots = {}
+        self.teams = {}
+        self.prototypes = []
+        self.permissions = collections.defaultdict(dict)
+        self.logs = []
+
+    @property
+    def request_count(self):
+        return sum(self.requests.values())
+
+    def log(self, kind, repo):
+        self.logs.append({"kind": kind, "metadata": {
+            "namespace": self.organization, "repo": repo},
+            "datetime": email.utils.formatdate()})
+
+    # Handlers return (status, body)
+    def list_repositories(self, query):
+        if query.get('namespace') != self.organization:
+            return 200, {"repositories": []}
+        start = int(query.get('next_page') or 0)
+        repos = self.repositories
+        if query.get('public') == "true":
+            repos = [repo for repo in repos if repo['is_public']]
+        page = {"repositories": repos[start:start + PAGE_SIZE]}
+        if start + PAGE_SIZE < len(repos):
+            page['next_page'] = str(start + PAGE_SIZE)
+        else:
+            self.listed = time.monotonic()
+        return 200, page
+
+    def list_tags(self, repo, query):
+        tags = self.tags[repo]
+        if query.get('specificTag'):
+            tags = [tag for tag in tags
+                    if tag['name'] == query['specificTag']]
+        if query.get('onlyActiveTags') == "true":
+            now = time.time()
+            tags = [tag for tag in tags if tag.get('end_ts', now + 1) > now]
+        limit = int(query.get('limit', 50))
+        page = int(query.get('page', 1))
+        start = (page - 1) * limit
+        return 200, {"tags": tags[start:start + limit], "page": page,
+                     "has_additional": start + limit < len(tags)}
+
+    def handle(self, method, path, query, body):
+        parts = path.strip("/").split("/")
+        if path.rstrip("/") == "/repository":
+            if method == "GET":
+                return self.list_repositories(query)
+            self.repositories.append({
+                "namespace": body['namespace'], "name": body['repository'],
+                "is_public": body['visibility'] == "public",
+                "kind": "image", "last_modified": int(time.time())})
+            self.index[body['repository']] = self.repositories[-1]
+            self.tags[body['repository']] = []
+            return 201, {}
+
+        if parts[0] == "repository" and len(parts) >= 3:
+            repo = self.index.get(parts[2])
+            if not repo:
+                return 404, {"error": "Not found"}
+            rest = parts[3:]
+            if rest == ["changevisibility"]:
+                repo['is_public'] = body['visibility'] == "public"
+                self.log("change_repo_visibility", repo['name'])
+                return 200, {"success": True}
+            if rest == ["tag"]:
+                return self.list_tags(repo['name'], query)
+            if len(rest) == 2 and rest[0] == "tag":
+                for tag in self.tags[repo['name']]:
+                    if tag['name'] == rest[1]:
+                        tag['expiration'] = body.get('expiration')
+                        if tag['expiration']:
+                            tag['end_ts'] = tag['expiration']
+                        else:
+                            tag.pop('end_ts', None)
+                self.log("change_tag_expiration", repo['name'])
+                return 201, "Updated"
+            if len(rest) == 3 and rest[2] == "restore":
+                return 200, {}
+            if rest[:1] == ["permissions"]:
+                perms = self.permissions[(repo['name'], rest[1])]
+                if len(rest) == 2:
+                    return 200, {"permissions": {
+                        name: {"role": role, "name": name}
+                        for name, role in perms.items()}}
+                if method == "PUT":
+                    perms[rest[2]] = body['role']
+                    return 200, {"role": body['role'], "name": rest[2]}
+                if rest[2] not in perms:
+                    return 400, {"message": "User does not have permission"}
+                return 200, {"role": perms[rest[2]], "name": rest[2]}
+            if rest[:1] == ["image"]:
+                return 200, {"images": []}
+
+        if parts[0] == "organization" and len(parts) >= 2:
+            rest = parts[2:]
+            if not rest:
+                return 200, {"name": parts[1], "teams": {
+                    team: {"name": team} for team in self.teams}}
+            if rest == ["robots"]:
+                return 200, {"robots": [
+                    {"name": "%s+%s" % (parts[1], robot), "token": token}
+                    for robot, token in self.robots.items()]}
+            if rest[0] == "robots":
+                token = "%032x" % self.random.getrandbits(128)
+                self.robots[rest[1]] = token
+                return 201, {"name": "%s+%s" % (parts[1], rest[1]),
+                             "token": token}
+            if rest[0] == "members" and len(rest) == 2:
+                repositories = sorted(
+                    repo for (repo, kind), perms in self.permissions.items()
+                    if kind == "user" and rest[1] in perms)
+                if not repositories:
+                    return 404, {"error": "Not found"}
+                return 200, {"name": rest[1], "repositories": repositories}
+            if rest == ["logs"]:
+                return 200, {"logs": self.logs}
+            if rest == ["prototypes"]:
+                if method == "POST":
+                    self.prototypes.append(body)
+                    return 200, body
+                return 200, {"prototypes": self.prototypes}
+            if rest[0] == "team":
+                members = self.teams.setdefault(rest[1], set()) \
+                    if method == "PUT" else self.teams.get(rest[1])
+                if members is None:
+                    return 404, {"error": "Not found"}
+                if rest[2:] == ["members"]:
+                    return 200, {"members": [{"name": name}
+                                             for name in members]}
+                if len(rest) == 4:
+                    members.add(rest[3])
+                return 200, {}
+        if path.rstrip("/") == "/user":
+            return 200, {"username": "bench", "organizations": [
+                {"name": self.organization}]}
+        if path == "/discovery":
+            return 200, {"apis": []}
+        return 404, {"error": "Not found"}
+
+
+def make_handler(quay):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        wbufsize = 65536
+
+        def log_message(self, *args):
+            pass
+
+        def _handle(self):
+            url = urllib.parse.urlparse(self.path)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"null") \
+                if length else None
+            path = url.path[len(API):] if url.path.startswith(API) \
+                else url.path
+            endpoint = re.sub(r"repo\d+", "{repository}", path)
+            with quay.lock:
+                quay.requests["%s %s" % (self.command, endpoint)] += 1
+                failing = quay.random.random() < quay.error_rate
+                if self.command != "GET" and quay.first_change is None:
+                    quay.first_change = time.monotonic()
+            latency = quay.latency
+            if self.command == "GET" and path.rstrip("/") == "/repository":
+                latency += quay.page_latency
+            if latency:
+                time.sleep(latency)
+            if failing:
+                status, data = 503, {"error": "Injected error"}
+            else:
+                with quay.lock:
+                    status, data = quay.handle(self.command, path, query,
+                                               body)
+            content = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+    return Handler
+
+
+class FakeQuayServer:
+    """Run a FakeQuay in a background thread, on a free local port."""
+
+    def __init__(self, quay):
+        self.quay = quay
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0),
+                                          make_handler(quay))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    @property
+    def api_url(self):
+        return "http://127.0.0.1:%s%s" % (self.server.server_port, API)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake Quay API")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--organization", default="bench")
+    parser.add_argument("--repositories", type=int, default=100)
+    parser.add_argument("--tags", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Delay of every answer, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="Part of the requests answered with a 503")
+    parser.add_argument("--page-latency", type=float, default=0,
+                        help="Extra delay of every repository listing page, "
+                        "in seconds")
+    args = parser.parse_args()
+    quay = FakeQuay(args.organization, args.repositories, args.tags,
+                    args.latency, args.error_rate,
+                    page_latency=args.page_latency)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port),
+                                 make_handler(quay))
+    print("Fake Quay API on http://127.0.0.1:%s%s" % (args.port, API))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Copyright 2022, Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare the requests per second of the pooled session and of one
+connection per request.
+
+The fake Quay runs in a child process, so that it does not share the GIL
+with the client. The pooled run sends the requests with quaytool call_api,
+the unpooled one with requests.get, as quaytool did before it had a
+session. One JSON line is written per run, e.g.:
+
+    python benchmarks/pooling.py --requests 2000 --jobs 1,8
+"""
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from fake_quay import FakeQuay, FakeQuayServer  # noqa: E402
+from quaytool import quaytool  # noqa: E402
+
+ORGANIZATION = "bench"
+HEADERS = {"Authorization": "Bearer bench"}
+
+
+def serve(connection, latency):
+    quay = FakeQuay(ORGANIZATION, 10, latency=latency)
+    with FakeQuayServer(quay) as server:
+        connection.send(server.api_url)
+        # NOTE: serve until the parent closes its end
+        try:
+            connection.recv()
+        except EOFError:
+            pass
+
+
+def pooled_get(url):
+    quaytool.call_api("GET", url).raise_for_status()
+
+
+def unpooled_get(url):
+    requests.get(url, headers=HEADERS, verify=True).raise_for_status()
+
+
+def measure(get, url, count, jobs):
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for future in [executor.submit(get, url) for _ in range(count)]:
+            future.result()
+    return time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=1000,
+                        help="Requests sent per run")
+    parser.add_argument("--jobs", default="1,8",
+                        help="Comma separated numbers of concurrent workers")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Delay of every fake Quay answer, in seconds")
+    args = parser.parse_args()
+
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve,
+                                      args=(child, args.latency),
+                                      daemon=True)
+    process.start()
+    try:
+        api_url = parent.recv()
+        url = "%s/repository/%s/repo000000/tag/" % (api_url, ORGANIZATION)
+        for jobs in [int(jobs) for jobs in args.jobs.split(",")]:
+            quaytool.setup_session(HEADERS, True, jobs)
+            for name, get in (("pooled", pooled_get),
+                              ("unpooled", unpooled_get)):
+                seconds = measure(get, url, args.requests, jobs)
+                print(json.dumps({
+                    "client": name, "jobs": jobs, "requests": args.requests,
+                    "latency": args.latency, "seconds": round(seconds, 3),
+                    "requests_per_second": round(args.requests / seconds,
+                                                 1)}))
+    finally:
+        parent.close()
+        process.join(5)
+
+
+if __name__ == "__main__":
+    main()
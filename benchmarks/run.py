@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+# Copyright 2022, Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run quaytool against a fake Quay API and report how it performed.
+
+Every run starts a fresh fake Quay in this process and quaytool in a
+subprocess, so the peak RSS is the one of quaytool only. One JSON line is
+written per run, e.g.:
+
+    python benchmarks/run.py --sizes 100,1000 --output results.jsonl
+
+The time of the first change received by the fake Quay tells whether the
+changes start while the repositories are still listed, e.g. with slow
+listing pages:
+
+    python benchmarks/run.py --scenarios set-visibility --sizes 10000 \
+        --page-latency 0.2
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_quay import FakeQuay, FakeQuayServer  # noqa: E402
+
+ORGANIZATION = "bench"
+DEFAULT_SIZES = "100,1000,10000,50000"
+SCENARIOS = {
+    "list": ["--list-repositories", "--output", "jsonl"],
+    "set-visibility": ["--set-visibility", "--visibility", "public"],
+    "expire": ["--expire", "1", "--tag", "tag0"],
+    "restore-tag": ["--restore-tag", "--tag", "deleted"],
+}
+
+
+def get_version():
+    try:
+        from importlib import metadata
+        return metadata.version("quaytool")
+    except Exception:
+        return "unknown"
+
+
+def run_quaytool(args, env):
+    """Run quaytool and return its exit code and its resource usage."""
+    with open(os.devnull, "w") as devnull:
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "quaytool.quaytool"] + args,
+            stdout=devnull, stderr=subprocess.PIPE, env=env)
+        stderr = proc.stderr.read()
+        # NOTE: wait4 gives the usage of this child, not of all children.
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = status
+    if os.WIFEXITED(status):
+        code = os.WEXITSTATUS(status)
+    else:
+        code = -os.WTERMSIG(status)
+    return code, usage, stderr.decode(errors="replace")
+
+
+def get_elapsed(start, end):
+    return round(end - start, 3) if end is not None else None
+
+
+def run_scenario(scenario, size, args):
+    quay = FakeQuay(ORGANIZATION, size, args.tags, args.latency,
+                    args.error_rate, args.seed, args.page_latency)
+    with tempfile.TemporaryDirectory() as cache_dir, \
+            FakeQuayServer(quay) as server:
+        env = dict(os.environ, XDG_CACHE_HOME=cache_dir)
+        command = ["--api-url", server.api_url, "--token", "bench",
+                   "--organization", ORGANIZATION, "--no-cache",
+                   "--jobs", str(args.jobs)] + SCENARIOS[scenario]
+        start = time.monotonic()
+        code, usage, stderr = run_quaytool(command, env)
+        wall_time = time.monotonic() - start
+
+    result = {
+        "scenario": scenario,
+        "repositories": size,
+        "jobs": args.jobs,
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "exit_code": code,
+        "page_latency": args.page_latency,
+        "wall_time": round(wall_time, 3),
+        # NOTE: from the start of quaytool, None when it did not happen
+        "first_change_time": get_elapsed(start, quay.first_change),
+        "listing_time": get_elapsed(start, quay.listed),
+        "user_time": round(usage.ru_utime, 3),
+        "system_time": round(usage.ru_stime, 3),
+        # NOTE: ru_maxrss is in kilobytes on Linux
+        "peak_rss_kb": usage.ru_maxrss,
+        "requests": quay.request_count,
+        "requests_by_endpoint": dict(sorted(quay.requests.items())),
+        "quaytool_version": get_version(),
+        "python_version": platform.python_version(),
+    }
+    if code:
+        result['stderr'] = stderr[-2000:]
+    return result
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help="Comma separated scenarios to run, from: %s" %
+                        ", ".join(SCENARIOS))
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help="Comma separated numbers of repositories")
+    parser.add_argument("--jobs", type=int, default=4,
+                        help="Value of the quaytool --jobs option")
+    parser.add_argument("--tags", type=int, default=5,
+                        help="Tags per repository")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Delay of every fake Quay answer, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="Part of the requests answered with a 503")
+    parser.add_argument("--page-latency", type=float, default=0,
+                        help="Extra delay of every repository listing page, "
+                        "in seconds")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the error injection")
+    parser.add_argument("--output", help="Append the results to this file "
+                        "instead of printing them")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    scenarios = args.scenarios.split(",")
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            print("Unknown scenario %s" % scenario)
+            sys.exit(1)
+    stream = open(args.output, "a") if args.output else sys.stdout
+    try:
+        for size in [int(size) for size in args.sizes.split(",")]:
+            for scenario in scenarios:
+                result = run_scenario(scenario, size, args)
+                stream.write(json.dumps(result) + "\n")
+                stream.flush()
+    finally:
+        if args.output:
+            stream.close()
+
+
+if __name__ == "__main__":
+    main()
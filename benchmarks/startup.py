@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Copyright 2022, Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Check that importing quaytool stays under a time budget.
+
+The import time comes from python -X importtime, the median of several
+runs. The check fails when it is over --budget milliseconds, or when a
+module that should only be loaded by the first request gets imported.
+"""
+
+import argparse
+import json
+import re
+import statistics
+import subprocess
+import sys
+
+DEFAULT_BUDGET = 50
+DEFAULT_RUNS = 5
+MODULE = "quaytool.quaytool"
+# Modules loaded on first use only.
+LAZY_MODULES = ("requests", "urllib3", "yaml", "http.server", "sqlite3",
+                "ssl")
+IMPORTTIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+
+def measure_import():
+    """Return the cumulative import time of MODULE in microseconds and the
+    imported modules.
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                           "import %s" % MODULE],
+                          stderr=subprocess.PIPE, check=True,
+                          universal_newlines=True)
+    cumulative = None
+    modules = set()
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME.match(line)
+        if not match:
+            continue
+        modules.add(match.group(4))
+        if match.group(4) == MODULE:
+            cumulative = int(match.group(2))
+    return cumulative, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET,
+                        help="Maximum import time in milliseconds")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS)
+    args = parser.parse_args()
+
+    # NOTE: the first run also writes the bytecode cache, it is not timed.
+    measure_import()
+    times = []
+    modules = set()
+    for _ in range(args.runs):
+        cumulative, modules = measure_import()
+        times.append(cumulative / 1000)
+
+    eager = sorted(module for module in LAZY_MODULES if module in modules)
+    result = {
+        "module": MODULE,
+        "import_time_ms": round(statistics.median(times), 1),
+        "budget_ms": args.budget,
+        "eager_modules": eager,
+    }
+    print(json.dumps(result))
+    if result['import_time_ms'] > args.budget or eager:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# Copyright 2022, Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import re
+import threading
+import time
+import urllib.parse
+
+from quaytool import lazy
+
+# NOTE: loaded on first use, see lazy.lazy_import
+hashlib = lazy.lazy_import("hashlib")
+sqlite3 = lazy.lazy_import("sqlite3")
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'quaytool')
+DEFAULT_MAX_ENTRIES = 5000
+
+# Endpoints that are cached, with their time to live in seconds.
+CACHE_TTLS = [
+    (re.compile(r"/repository/?$"), 300),
+    (re.compile(r"/organization/[^/]+/robots/?$"), 600),
+    (re.compile(r"/organization/[^/]+/team/[^/]+/members/?$"), 600),
+    (re.compile(r"/organization/[^/]+/prototypes/?$"), 600),
+]
+
+
+def get_ttl(url):
+    path = urllib.parse.urlparse(url).path
+    for pattern, ttl in CACHE_TTLS:
+        if pattern.search(path):
+            return ttl
+
+
+def get_scope(url):
+    """Return the organization that the API url belongs to."""
+    parsed = urllib.parse.urlparse(url)
+    parts = parsed.path.split('/api/v1/', 1)[-1].strip('/').split('/')
+    if parts[0] in ('organization', 'repository') and len(parts) > 1:
+        return parts[1]
+    namespace = urllib.parse.parse_qs(parsed.query).get('namespace')
+    if namespace:
+        return namespace[0]
+
+
+def get_identity(headers):
+    token = (headers or {}).get('Authorization', '')
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class MetadataCache:
+    """SQLite backed cache of the Quay API listing responses.
+
+    Entries are keyed by the full request url and a hash of the token. They
+    are served while their TTL is valid, then revalidated with their ETag
+    when Quay sent one. The least recently used entries are dropped when
+    there are more than max_entries.
+    """
+
+    def __init__(self, path=None, max_entries=DEFAULT_MAX_ENTRIES,
+                 refresh=False):
+        path = path or os.path.join(DEFAULT_CACHE_DIR, 'cache.sqlite')
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # NOTE: listings can contain robot tokens.
+        os.chmod(path, 0o600)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "url TEXT, identity TEXT, scope TEXT, etag TEXT, body BLOB, "
+            "expires REAL, used REAL, PRIMARY KEY (url, identity))")
+        self._db.commit()
+
+    def get(self, url, identity):
+        """Return (body, etag, fresh) for the url or None when not cached."""
+        if self.refresh:
+            return
+        with self._lock:
+            row = self._db.execute(
+                "SELECT body, etag, expires FROM responses "
+                "WHERE url = ? AND identity = ?", (url, identity)).fetchone()
+            if not row:
+                return
+            self._db.execute(
+                "UPDATE responses SET used = ? WHERE url = ? AND "
+                "identity = ?", (time.time(), url, identity))
+            self._db.commit()
+        body, etag, expires = row
+        return body, etag, expires > time.time()
+
+    def set(self, url, identity, body, etag=None, ttl=None):
+        ttl = ttl if ttl is not None else get_ttl(url) or 0
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, identity, get_scope(url), etag, body, now + ttl, now))
+            self._evict()
+            self._db.commit()
+
+    def touch(self, url, identity, ttl=None):
+        ttl = ttl if ttl is not None else get_ttl(url) or 0
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "UPDATE responses SET expires = ?, used = ? WHERE url = ? "
+                "AND identity = ?", (now + ttl, now, url, identity))
+            self._db.commit()
+
+    def invalidate(self, url):
+        """Drop the cached entries of the organization changed by url."""
+        scope = get_scope(url)
+        with self._lock:
+            if scope:
+                self._db.execute("DELETE FROM responses WHERE scope = ?",
+                                 (scope,))
+            else:
+                self._db.execute("DELETE FROM responses")
+            self._db.commit()
+        logging.debug("Invalidated cache entries for %s", scope or "all")
+
+    def _evict(self):
+        self._db.execute(
+            "DELETE FROM responses WHERE rowid IN (SELECT rowid FROM "
+            "responses ORDER BY used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,148 @@
+# Copyright 2022, Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import json
+import os
+import shutil
+import threading
+import time
+
+from quaytool import cache
+
+DEFAULT_JOBS_DIR = os.path.join(cache.DEFAULT_CACHE_DIR, 'jobs')
+SYNC_EVERY = 100
+SYNC_INTERVAL = 1.0
+
+
+class JournalError(Exception):
+    pass
+
+
+def job_exists(job_id, directory=DEFAULT_JOBS_DIR):
+    return os.path.exists(os.path.join(directory, job_id, "meta.json"))
+
+
+def new_job_id():
+    return "%s-%s" % (datetime.datetime.now().strftime("%Y%m%d-%H%M%S"),
+                      os.urandom(3).hex())
+
+
+class Journal:
+    """Append-only record of the repositories done by a bulk job.
+
+    The job directory keeps the action of the job, the repositories it
+    works on and one line per finished repository. The lines are synced
+    to disk every SYNC_EVERY entries or SYNC_INTERVAL seconds, not after
+    each request.
+    """
+
+    def __init__(self, action, job_id=None, directory=DEFAULT_JOBS_DIR,
+                 resume=None):
+        self.resumed = bool(job_id) if resume is None else resume
+        self.job_id = job_id or new_job_id()
+        self.path = os.path.join(directory, self.job_id)
+        self.action = action
+        self.done = set()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._synced = time.monotonic()
+
+        meta_path = os.path.join(self.path, "meta.json")
+        if self.resumed:
+            if not os.path.exists(meta_path):
+                raise JournalError("Can not find job %s" % self.job_id)
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta['action'] != action:
+                raise JournalError("Job %s was started for %s, not %s" % (
+                    self.job_id, meta['action'], action))
+            self._load()
+        else:
+            os.makedirs(self.path, mode=0o700)
+            with open(meta_path, "w") as f:
+                json.dump({"action": action,
+                           "started": time.time()}, f)
+
+        self._entries = open(os.path.join(self.path, "journal.jsonl"), "a")
+
+    def _load(self):
+        path = os.path.join(self.path, "journal.jsonl")
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # NOTE: last line of an interrupted write
+                    continue
+                if entry['result'] == "ok":
+                    self.done.add(entry['repository'])
+                else:
+                    self.done.discard(entry['repository'])
+
+    def load_repositories(self):
+        """Return the repositories listed by the job, if it listed all."""
+        path = os.path.join(self.path, "repositories.jsonl")
+        if not self.resumed or not os.path.exists(
+                os.path.join(self.path, "repositories.done")):
+            return
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    def track_repositories(self, repositories):
+        """Yield the repositories while keeping them in the job directory."""
+        path = os.path.join(self.path, "repositories.jsonl")
+        with open(path, "w") as f:
+            for repo in repositories:
+                f.write(json.dumps(repo) + "\n")
+                yield repo
+            f.flush()
+            os.fsync(f.fileno())
+        open(os.path.join(self.path, "repositories.done"), "w").close()
+
+    def is_done(self, repository):
+        return repository in self.done
+
+    def record(self, repository, result, error=None):
+        entry = {"repository": repository, "action": self.action,
+                 "result": result, "time": time.time()}
+        if error:
+            entry['error'] = str(error)
+        with self._lock:
+            self._entries.write(json.dumps(entry) + "\n")
+            if result == "ok":
+                self.done.add(repository)
+            self._pending += 1
+            if (self._pending >= SYNC_EVERY or
+                    time.monotonic() - self._synced >= SYNC_INTERVAL):
+                self._sync()
+
+    def _sync(self):
+        self._entries.flush()
+        os.fsync(self._entries.fileno())
+        self._pending = 0
+        self._synced = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if not self._entries.closed:
+                self._sync()
+                self._entries.close()
+
+    def remove(self):
+        """Close the journal and delete the job directory."""
+        self.close()
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,46 @@
+# Copyright 2022, Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib
+import importlib.util
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Stand-in for a module, imported on its first attribute access."""
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attribute):
+        module = self.__dict__['_module']
+        if module is None:
+            # NOTE: import_module holds the import lock, so the workers
+            # can race on the first access.
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_module'] = module
+        return getattr(module, attribute)
+
+
+def lazy_import(name):
+    """Return the module name, only imported on its first attribute access.
+
+    The CLI is often run for --help or fails on its arguments, it should
+    not pay for requests, urllib3 and the TLS setup then. Returns None when
+    the module is not installed.
+    """
+    if importlib.util.find_spec(name) is None:
+        return
+    return LazyModule(name)
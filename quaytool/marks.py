@@ -0,0 +1,122 @@
+# Copyright 2022, Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import json
+import os
+import threading
+import urllib.parse
+
+from quaytool import cache
+
+DEFAULT_MARKS_PATH = os.path.join(cache.DEFAULT_CACHE_DIR, 'marks.json')
+LAST_RUN = "last-run"
+
+
+def parse_since(value):
+    """Return the timestamp of a --since value, or LAST_RUN.
+
+    The value is a Unix timestamp or an ISO 8601 date, in UTC unless it
+    has an offset.
+    """
+    if value == LAST_RUN:
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    date = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp()
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(
+        timestamp, datetime.timezone.utc).isoformat()
+
+
+def get_key(api_url, organization, action):
+    return "%s %s %s" % (urllib.parse.urlparse(api_url).netloc, organization,
+                         action)
+
+
+class HighWaterMarks:
+    """Newest change seen by the last successful run of each bulk action.
+
+    The marks are kept in a JSON file, keyed by registry, organization and
+    action.
+    """
+
+    def __init__(self, path=DEFAULT_MARKS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def get(self, key):
+        with self._lock:
+            return self._load().get(key)
+
+    def set(self, key, timestamp):
+        with self._lock:
+            marks = self._load()
+            marks[key] = timestamp
+            os.makedirs(os.path.dirname(self.path), mode=0o700,
+                        exist_ok=True)
+            tmp_path = "%s.%s.tmp" % (self.path, os.getpid())
+            with open(tmp_path, "w") as f:
+                json.dump(marks, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+
+class ChangeFilter:
+    """Keep the repositories changed since a timestamp.
+
+    A repository changed when its last_modified is newer, or when it is in
+    names, the repositories found in the usage logs. The repositories that
+    were never pushed have no last_modified and are always kept. The newest
+    last_modified seen becomes the next high-water mark, unless the listing
+    was partial: the repositories it missed may be older.
+    """
+
+    def __init__(self, key, since=None, names=None, partial=False):
+        self.key = key
+        self.since = since
+        self.names = names
+        self.partial = partial
+        self.newest = None
+        self.skipped = 0
+
+    def filter(self, repositories):
+        for repo in repositories:
+            last_modified = repo.get('last_modified')
+            if last_modified and (self.newest is None or
+                                  last_modified > self.newest):
+                self.newest = last_modified
+            if self.since is not None and not self._changed(repo):
+                self.skipped += 1
+                continue
+            yield repo
+
+    def _changed(self, repo):
+        if self.names is not None:
+            return repo['name'] in self.names
+        last_modified = repo.get('last_modified')
+        return not last_modified or last_modified >= self.since
@@ -0,0 +1,130 @@
+# Copyright 2022, Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import json
+import sys
+
+FORMATS = ("json", "jsonl", "csv", "table")
+
+
+def select_fields(record, fields):
+    if not fields:
+        return record
+    return {field: record.get(field) for field in fields}
+
+
+def _to_text(value):
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+class JsonLinesWriter:
+    def __init__(self, stream, fields=None):
+        self.stream = stream
+        self.fields = fields
+
+    def write(self, record):
+        self.stream.write(json.dumps(select_fields(record, self.fields)) +
+                          "\n")
+
+    def close(self):
+        self.stream.flush()
+
+
+class JsonWriter(JsonLinesWriter):
+    """Write a JSON list, one record at a time."""
+
+    def __init__(self, stream, fields=None):
+        super().__init__(stream, fields)
+        self.count = 0
+
+    def write(self, record):
+        self.stream.write("[\n" if not self.count else ",\n")
+        self.stream.write(json.dumps(select_fields(record, self.fields)))
+        self.count += 1
+
+    def close(self):
+        self.stream.write("\n]\n" if self.count else "[]\n")
+        self.stream.flush()
+
+
+class CsvWriter(JsonLinesWriter):
+    """Write CSV rows. Without fields, the first record gives the columns."""
+
+    def __init__(self, stream, fields=None):
+        super().__init__(stream, fields)
+        self.writer = None
+
+    def write(self, record):
+        if not self.writer:
+            self.writer = csv.DictWriter(
+                self.stream, fieldnames=self.fields or list(record),
+                extrasaction="ignore")
+            self.writer.writeheader()
+        self.writer.writerow({field: _to_text(record.get(field))
+                              for field in self.writer.fieldnames})
+
+
+class TableWriter(JsonLinesWriter):
+    """Write an aligned text table.
+
+    The width of the columns depends on every record, so this is the only
+    format that keeps the records in memory until the end.
+    """
+
+    def __init__(self, stream, fields=None):
+        super().__init__(stream, fields)
+        self.rows = []
+
+    def write(self, record):
+        if not self.fields:
+            self.fields = list(record)
+        self.rows.append([_to_text(record.get(field))
+                          for field in self.fields])
+
+    def close(self):
+        if self.fields:
+            rows = [self.fields] + self.rows
+            widths = [max(len(row[i]) for row in rows)
+                      for i in range(len(self.fields))]
+            for row in rows:
+                self.stream.write("  ".join(
+                    value.ljust(width)
+                    for value, width in zip(row, widths)).rstrip() + "\n")
+        self.stream.flush()
+
+
+WRITERS = {
+    "json": JsonWriter,
+    "jsonl": JsonLinesWriter,
+    "csv": CsvWriter,
+    "table": TableWriter,
+}
+
+
+def get_writer(output_format, fields=None, stream=None):
+    return WRITERS[output_format](stream or sys.stdout, fields)
+
+
+def write_records(records, output_format, fields=None, stream=None):
+    writer = get_writer(output_format, fields, stream)
+    try:
+        for record in records:
+            writer.write(record)
+    finally:
+        writer.close()
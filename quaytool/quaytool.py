@@ -15,19 +15,72 @@
 # limitations under the License.
 
 import argparse
+import atexit
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import fnmatch
+import functools
+import itertools
+import json
 import logging
-import requests
 import os
+import re
 import sys
+import threading
+import time
+import urllib.parse
+
+from quaytool import cache
+from quaytool import journal
+from quaytool import lazy
+from quaytool import marks
+from quaytool import output
+from quaytool import retention
+from quaytool import scheduler
+from quaytool import stats
+from quaytool import storage
+
+# NOTE: loaded on first use, see lazy.lazy_import
+email_utils = lazy.lazy_import("email.utils")
+requests = lazy.lazy_import("requests")
+server = lazy.lazy_import("quaytool.server")
+yaml = lazy.lazy_import("yaml")
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_JOBS = 4
+DEFAULT_LISTEN = "unix:%s" % os.path.join(cache.DEFAULT_CACHE_DIR,
+                                          "serve.sock")
+DEFAULT_SERVE_SECRET = os.path.join(cache.DEFAULT_CACHE_DIR, "serve.secret")
+DEFAULT_MAX_TARGETS = 4
+TAG_PAGE_LIMIT = 100
+# How long the daemon keeps an organization state in memory, in seconds.
+STATE_TTL = 300
+# How often the daemon writes the --stats-file, in seconds.
+STATS_INTERVAL = 60
+# Returned by the bulk workers when the repository is already as wanted.
+UNCHANGED = "unchanged"
+
+# NOTE: One keep-alive session shared by every API call, so the TCP and TLS
+# handshakes are done once per connection in the pool, not once per request.
+_session = None
+_session_options = ()
+_session_lock = threading.Lock()
+_cache = None
+_scheduler = None
+# Schedulers of the registries given with --registries, by API host.
+_schedulers = {}
+_request_hooks = []
+_print_lock = threading.Lock()
 
 
 def get_args():
     parser = argparse.ArgumentParser(description="Change repositories "
                                      "in namespace")
     require = parser.add_argument_group("Required params")
-    require.add_argument("--api-url", help="Quay API url",
-                         required=True)
+    require.add_argument("--api-url", help="Quay API url. Not needed with "
+                         "--registries")
     # parameters that are needed to perfom some actions
     parser.add_argument("--token", help="Application token to operate on "
                         "registry",
@@ -35,7 +88,12 @@ def get_args():
     parser.add_argument("--user", help="Operate on specified user")
     parser.add_argument("--info", help="Show Quay information",
                         action="store_true")
-    parser.add_argument("--organization", help="Specify Quay organization")
+    parser.add_argument("--organization", help="Specify Quay organization. "
+                        "--set-visibility, --set-permissions, --expire, "
+                        "--restore-tag, --retention and --list-repositories "
+                        "accept a "
+                        "comma separated list of names and globs, like "
+                        "'infra,team-*'")
     parser.add_argument("--team", help="Organization team name")
     parser.add_argument("--repository", help="Apply changes only on requested "
                         "repository. Can be used multiple times",
@@ -70,7 +128,9 @@ def get_args():
                         "NOTE: requires --token and --organization param",
                         action="store_true")
     # create
-    action.add_argument("--create-repository", help="Create repository in org",
+    action.add_argument("--create-repository", help="Create the --repository "
+                        "repositories and the ones of --manifest that are "
+                        "missing in the organization",
                         action="store_true")
     action.add_argument("--create-organization", help="Create organization in"
                         "Quay service. NOTE: requires --token and "
@@ -95,6 +155,26 @@ def get_args():
     action.add_argument("--regenerate-token", help="Regenerate token for "
                         "requested robot name. NOTE: need --organization and"
                         "--robot parameter")
+    action.add_argument("--audit-permissions", help="Print the user and "
+                        "team roles on the repositories of the organization, "
+                        "one record per principal and repository, grouped "
+                        "by principal. Can be used with --repository, "
+                        "--skip-repo, --output and --fields",
+                        action="store_true")
+    action.add_argument("--storage-report", help="Print the size of the "
+                        "active tags of the organization, the --top largest "
+                        "repositories and the --top largest tags. A manifest "
+                        "shared by several tags is counted once. Can be used "
+                        "with --repository, --skip-repo, --output and "
+                        "--fields",
+                        action="store_true")
+    action.add_argument("--rotate-tokens", help="Regenerate the tokens of "
+                        "the robots selected by --robot, --robot-pattern "
+                        "and --robot-glob, every robot without them, in the "
+                        "organizations. The new tokens are written to "
+                        "--tokens-file, or to stdout as JSON Lines. Can be "
+                        "used with --dry-run and --resume",
+                        action="store_true")
     action.add_argument("--add-member", help="Add user into the team. NOTE: "
                         "it requires parameters: --organization, --team and "
                         "--user",
@@ -109,7 +189,52 @@ def get_args():
                         "--organization and --tag. Can be used with "
                         "--skip-repo",
                         type=int)
+    action.add_argument("--retention", help="Expire the tags that the "
+                        "retention policy given by --keep-last and "
+                        "--older-than does not keep, among the tags "
+                        "selected by --tag-pattern and --tag-glob. NOTE: it "
+                        "requires --organization. Can be used with "
+                        "--dry-run and --skip-repo",
+                        action="store_true")
+    action.add_argument("--apply", help="Apply the desired state of the "
+                        "organization described in a YAML or JSON file. "
+                        "Use - to read JSON from stdin. Can be used with "
+                        "--dry-run",
+                        metavar="STATE_FILE")
+    action.add_argument("--batch", help="Run the operations described as "
+                        "JSON Lines in a file, or - for stdin. For example: "
+                        '{"op": "create-robot", "organization": "myorg", '
+                        '"robot": "bender"}. One JSON result is printed per '
+                        "operation",
+                        metavar="FILE")
+    action.add_argument("--serve", help="Run as a daemon serving the "
+                        "quaytool operations as a JSON API on --listen, "
+                        "with the --token of the daemon. Clients send the "
+                        "secret of --serve-secret-file as bearer token",
+                        action="store_true")
     optional = parser.add_argument_group("Optional parameters")
+    optional.add_argument("--output", help="Print the listings in the given "
+                          "format instead of a Python dict",
+                          choices=output.FORMATS)
+    optional.add_argument("--fields", help="Comma separated list of fields "
+                          "to print with --output. For example: "
+                          "name,is_public,last_modified",
+                          type=lambda value: [
+                              field.strip() for field in value.split(",")
+                              if field.strip()])
+    optional.add_argument("--resume", help="Resume an interrupted "
+                          "--set-visibility, --set-permissions, --expire, "
+                          "--restore-tag, --retention or --rotate-tokens "
+                          "job, skipping the repositories or robots it "
+                          "already did",
+                          metavar="JOB_ID")
+    optional.add_argument("--force", help="Send the changes even to the "
+                          "repositories that already are in the wanted "
+                          "state",
+                          action="store_true")
+    optional.add_argument("--dry-run", help="Only show the changes that "
+                          "would be done, nothing is sent",
+                          action="store_true")
     optional.add_argument("--skip-repo", help="Skip repositories that change "
                           "should not be applied. Can be used multiple times",
                           action="append",
@@ -120,6 +245,124 @@ def get_args():
                           choices=["public", "private"])
     optional.add_argument("--insecure", help="Skip validating SSL cert",
                           action="store_false")
+    optional.add_argument("--pool-size", help="Number of keep-alive "
+                          "connections kept open to the Quay API",
+                          type=int,
+                          default=DEFAULT_POOL_SIZE)
+    optional.add_argument("--no-cache", help="Do not use the local cache "
+                          "of organization listings",
+                          action="store_true")
+    optional.add_argument("--refresh", help="Ignore the cached listings and "
+                          "fetch them again from Quay",
+                          action="store_true")
+    optional.add_argument("--max-rps", help="Maximum number of requests per "
+                          "second sent to the Quay API",
+                          type=float)
+    optional.add_argument("--retries", help="How many times a request is "
+                          "retried when Quay is overloaded or unreachable",
+                          type=int,
+                          default=scheduler.DEFAULT_RETRIES)
+    optional.add_argument("--limit", help="Maximum number of repositories "
+                          "printed by --list-repositories",
+                          type=int)
+    optional.add_argument("--next-page", help="Start --list-repositories "
+                          "from a next_page token of an earlier listing")
+    optional.add_argument("--stats", help="Print per endpoint request "
+                          "statistics at exit",
+                          action="store_true")
+    optional.add_argument("--stats-file", help="Write per endpoint request "
+                          "statistics at exit, and every minute with "
+                          "--serve, as Prometheus text when the file ends "
+                          "with .prom, as JSON otherwise")
+    optional.add_argument("--max-pages", help="Stop listing repositories "
+                          "after that many pages",
+                          type=int)
+    optional.add_argument("--jobs", help="Number of repositories or robots "
+                          "processed in parallel by --set-visibility, "
+                          "--set-permissions, --expire, --restore-tag, "
+                          "--retention, --create-repository, "
+                          "--rotate-tokens, --audit-permissions and "
+                          "--storage-report",
+                          type=int,
+                          default=DEFAULT_JOBS)
+    optional.add_argument("--fail-fast", help="Stop bulk operations on the "
+                          "first failed repository",
+                          action="store_true")
+    optional.add_argument("--manifest", help="YAML or JSON file listing the "
+                          "repositories created by --create-repository, as "
+                          "names or with their visibility and description")
+    optional.add_argument("--top", help="Number of largest repositories and "
+                          "tags printed by --storage-report",
+                          type=int,
+                          default=storage.DEFAULT_TOP)
+    optional.add_argument("--robot-pattern", help="Regular expression of the "
+                          "robot names, without the organization, handled "
+                          "by --rotate-tokens. Can be used multiple times",
+                          action="append",
+                          default=[])
+    optional.add_argument("--robot-glob", help="Glob of the robot names "
+                          "handled by --rotate-tokens. Can be used multiple "
+                          "times",
+                          action="append",
+                          default=[])
+    optional.add_argument("--tokens-file", help="File where --rotate-tokens "
+                          "appends the new tokens as JSON Lines. It is only "
+                          "readable by its owner",
+                          metavar="FILE")
+    optional.add_argument("--tag-pattern", help="Regular expression of the "
+                          "tags handled by --retention. Can be used "
+                          "multiple times",
+                          action="append",
+                          default=[])
+    optional.add_argument("--tag-glob", help="Glob of the tags handled by "
+                          "--retention. Can be used multiple times",
+                          action="append",
+                          default=[])
+    optional.add_argument("--keep-last", help="Number of newest tags kept "
+                          "by --retention in every repository",
+                          type=int)
+    optional.add_argument("--older-than", help="Only expire the tags older "
+                          "than that many days with --retention",
+                          type=int)
+    optional.add_argument("--grace-days", help="In how many days the tags "
+                          "expired by --retention expire",
+                          type=int,
+                          default=1)
+    optional.add_argument("--since", help="Only work on the repositories "
+                          "changed since a Unix timestamp or an ISO 8601 "
+                          "date, or since the last successful run of the "
+                          "same action with last-run. Used by "
+                          "--set-visibility, --set-permissions, --expire, "
+                          "--restore-tag and --retention",
+                          type=marks.parse_since,
+                          metavar="TIMESTAMP|last-run")
+    optional.add_argument("--since-source", help="Find the changed "
+                          "repositories from their last_modified date in "
+                          "the listing, or from the usage logs of the "
+                          "organization, that also have the permission and "
+                          "visibility changes",
+                          choices=["listing", "logs"],
+                          default="listing")
+    optional.add_argument("--registries", help="YAML or JSON file listing "
+                          "the registries to work on, with their api_url, "
+                          "token or token_file, organizations, jobs and "
+                          "max_rps",
+                          metavar="FILE")
+    optional.add_argument("--max-targets", help="Number of organizations "
+                          "processed in parallel when working on several "
+                          "organizations",
+                          type=int,
+                          default=DEFAULT_MAX_TARGETS)
+    optional.add_argument("--listen", help="Address of the --serve daemon, "
+                          "as HOST:PORT or unix:PATH. Default: %s" % (
+                              DEFAULT_LISTEN),
+                          default=DEFAULT_LISTEN)
+    optional.add_argument("--serve-secret-file", help="File with the secret "
+                          "that the clients of the --serve daemon send as "
+                          "bearer token, created when missing. Default: %s"
+                          % DEFAULT_SERVE_SECRET,
+                          default=DEFAULT_SERVE_SECRET,
+                          metavar="FILE")
     return parser.parse_args()
 
 
@@ -128,11 +371,139 @@ def gen_headers(token):
             "content-type": "application/json"}
 
 
-def get_repo_info(api_url, headers, insecure, organization, token=False):
-    next_page = "&next_page=%s" % token if token else ""
-    organization_info = requests.get("%s/repository?namespace=%s%s" % (
-        api_url, organization, next_page), headers=headers, verify=insecure)
-    return organization_info.json()
+def report(message):
+    # NOTE: bulk workers print from several threads, keep lines whole.
+    with _print_lock:
+        print(message)
+
+
+def setup_session(headers=None, insecure=True, pool_size=DEFAULT_POOL_SIZE):
+    """Set the options of the session, created on the first request."""
+    global _session, _session_options
+    _session = None
+    _session_options = (headers, insecure, pool_size)
+
+
+def _make_session(headers=None, insecure=True, pool_size=DEFAULT_POOL_SIZE):
+    if not insecure:
+        requests.packages.urllib3.disable_warnings()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if headers:
+        session.headers.update(headers)
+    session.verify = insecure
+    return session
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _make_session(*_session_options)
+        return _session
+
+
+def setup_scheduler(max_rps=None, max_concurrency=None,
+                    retries=scheduler.DEFAULT_RETRIES, api_url=None):
+    """Set the scheduler of the requests, or of the requests to the host of
+    api_url only.
+    """
+    global _scheduler
+    request_scheduler = scheduler.RequestScheduler(max_rps, max_concurrency,
+                                                   retries)
+    if api_url:
+        _schedulers[urllib.parse.urlparse(api_url).netloc] = (
+            request_scheduler)
+    else:
+        _scheduler = request_scheduler
+    return request_scheduler
+
+
+def add_request_hook(hook):
+    """Call hook after every request sent to Quay, retries included.
+
+    The hook gets the method and url as arguments, and the response or
+    error, elapsed time in seconds and attempt number as keywords.
+    """
+    _request_hooks.append(hook)
+
+
+def _send(method, url, headers=None, insecure=True, **kwargs):
+    attempts = itertools.count()
+
+    def send():
+        attempt = next(attempts)
+        start = time.monotonic()
+        response = error = None
+        try:
+            response = get_session().request(method, url, headers=headers,
+                                             verify=insecure, **kwargs)
+            return response
+        except requests.exceptions.RequestException as e:
+            error = e
+            raise
+        finally:
+            for hook in _request_hooks:
+                hook(method, url, response=response, error=error,
+                     elapsed=time.monotonic() - start, attempt=attempt)
+
+    request_scheduler = _scheduler
+    if _schedulers:
+        request_scheduler = _schedulers.get(urllib.parse.urlparse(url).netloc,
+                                            _scheduler)
+    if request_scheduler:
+        return request_scheduler.send(method, url, send)
+    return send()
+
+
+def setup_cache(refresh=False, path=None):
+    global _cache
+    _cache = cache.MetadataCache(path, refresh=refresh)
+    return _cache
+
+
+def _cached_response(url, body):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.encoding = "utf-8"
+    response.headers["content-type"] = "application/json"
+    response._content = body
+    return response
+
+
+def _cached_get(url, headers, insecure, **kwargs):
+    prepared = requests.models.PreparedRequest()
+    prepared.prepare_url(url, kwargs.get('params'))
+    identity = cache.get_identity(dict(get_session().headers,
+                                       **(headers or {})))
+    cached = _cache.get(prepared.url, identity)
+    if cached and cached[2]:
+        logging.debug("Using cached response for %s", prepared.url)
+        return _cached_response(prepared.url, cached[0])
+    if cached and cached[1]:
+        headers = dict(headers or {}, **{"If-None-Match": cached[1]})
+
+    r = _send("GET", url, headers, insecure, **kwargs)
+    if r.status_code == 304 and cached:
+        _cache.touch(prepared.url, identity)
+        return _cached_response(prepared.url, cached[0])
+    if r.status_code == 200:
+        _cache.set(prepared.url, identity, r.content, r.headers.get("ETag"))
+    return r
+
+
+def call_api(method, url, headers=None, insecure=True, **kwargs):
+    if _cache and method == "GET" and cache.get_ttl(url):
+        return _cached_get(url, headers, insecure, **kwargs)
+
+    r = _send(method, url, headers, insecure, **kwargs)
+    if _cache and method != "GET" and r.ok:
+        _cache.invalidate(url)
+    return r
 
 
 def get_next_page_token(namespace_info):
@@ -141,87 +512,370 @@ def get_next_page_token(namespace_info):
 
 
 def filter_defined_repos(defined_repos, repositories):
+    defined_repos = set(defined_repos)
     return [x for x in repositories if x['name'] in defined_repos]
 
 
 def filter_skipped_repos(skip_repo, repositories):
+    skip_repo = set(skip_repo)
     return [r for r in repositories if not (r['name'] in skip_repo)]
 
 
-def get_organization_details(api_url, headers, insecure, organization,
-                             defined_repos, skip_repo):
-    repositories = []
-    namespace_info = get_repo_info(api_url, headers, insecure, organization)
+def repo_key(repo):
+    return (repo.get('namespace'), repo['name'])
 
-    if not namespace_info or 'repositories' not in namespace_info:
-        print("No repo found!")
-        sys.exit(1)
 
-    repositories = namespace_info.get('repositories')
-    next_page_token = get_next_page_token(namespace_info)
-    if next_page_token:
-        while True:
-            namespace_info = get_repo_info(api_url, headers, insecure,
-                                           organization, next_page_token)
-            if 'repositories' in namespace_info:
-                ns_repos = namespace_info.get('repositories')
-                # NOTE: Workaround for never ending loop with "next_page"
-                # token, that contains same repositories as earlier.
-                if all(repo in repositories for repo in ns_repos):
-                    break
-                repositories += ns_repos
+def get_page(url, headers, insecure, params=None, token=None):
+    params = dict(params or {})
+    if token:
+        params['next_page'] = token
+    r = call_api("GET", url, headers, insecure, params=params)
+    r.raise_for_status()
+    return r.json()
+
+
+def iter_pages(url, headers, insecure, params=None, next_page=None,
+               max_pages=None):
+    """Yield the pages of a Quay listing that is paginated with next_page.
+
+    The next page is requested in the background as soon as its token is
+    known, so the caller can work on the current page meanwhile. The
+    listing can start from a next_page token saved from an earlier run.
+    """
+    seen_tokens = {next_page} if next_page else set()
+    pages = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetch:
+        page = prefetch.submit(get_page, url, headers, insecure, params,
+                               next_page)
+        while page:
+            current_page = page.result()
+            pages += 1
+            next_page_token = get_next_page_token(current_page or {})
+            page = None
+            if next_page_token in seen_tokens:
+                logging.warning("Page token %s was already used, stopping "
+                                "the pagination", next_page_token)
+            elif max_pages and pages >= max_pages and next_page_token:
+                logging.warning("Reached the limit of %s pages, stopping "
+                                "the pagination", max_pages)
+            elif next_page_token:
+                seen_tokens.add(next_page_token)
+                page = prefetch.submit(get_page, url, headers, insecure,
+                                       params, next_page_token)
+            yield current_page
+
+
+def iter_repo_pages(api_url, headers, insecure, organization,
+                    max_pages=None, last_modified=False):
+    """Yield the repository listing pages of the organization."""
+    params = {"namespace": organization}
+    if last_modified:
+        params['last_modified'] = "true"
+    return iter_pages("%s/repository" % api_url, headers, insecure, params,
+                      max_pages=max_pages)
+
+
+def iter_organization_repositories(api_url, headers, insecure, organization,
+                                   defined_repos, skip_repo, max_pages=None,
+                                   last_modified=False):
+    """Yield the filtered repositories of the organization page by page."""
+    seen = set()
+    first_page = True
+    for namespace_info in iter_repo_pages(api_url, headers, insecure,
+                                          organization, max_pages,
+                                          last_modified):
+        if first_page and (not namespace_info or
+                           'repositories' not in namespace_info):
+            print("No repo found!")
+            sys.exit(1)
+        first_page = False
+
+        if 'repositories' not in namespace_info:
+            continue
+
+        ns_repos = [repo for repo in namespace_info.get('repositories')
+                    if repo_key(repo) not in seen]
+        # NOTE: Workaround for never ending loop with "next_page"
+        # token, that contains same repositories as earlier.
+        if not ns_repos and namespace_info.get('repositories'):
+            break
+        seen.update(repo_key(repo) for repo in ns_repos)
+
+        if defined_repos:
+            ns_repos = filter_defined_repos(defined_repos, ns_repos)
 
-            if not get_next_page_token(namespace_info):
-                break
+        if skip_repo:
+            ns_repos = filter_skipped_repos(skip_repo, ns_repos)
 
-    print("The organization got %s repositories" % len(repositories))
+        for repo in ns_repos:
+            yield repo
 
-    if defined_repos:
-        repositories = filter_defined_repos(defined_repos, repositories)
+    print("The organization got %s repositories" % len(seen))
 
-    if skip_repo:
-        repositories = filter_skipped_repos(skip_repo, repositories)
 
+def get_organization_details(api_url, headers, insecure, organization,
+                             defined_repos, skip_repo, max_pages=None):
+    repositories = list(iter_organization_repositories(
+        api_url, headers, insecure, organization, defined_repos, skip_repo,
+        max_pages))
     print("After filtering, there are %s repositories" % len(repositories))
     return repositories
 
 
-def make_visibility(api_url, headers, insecure, repositories, visibility):
+def run_bulk(action, repositories, jobs=DEFAULT_JOBS, fail_fast=False,
+             job=None):
+    """Run action(repo) for every repository using a pool of jobs workers.
+
+    The repositories can be a generator: work is submitted as soon as a
+    repository is yielded. With a job journal, the repositories already
+    done by the job are skipped and the new results are recorded.
+    Returns the list of (repository, action result) in the same order as
+    repositories, and the list of (repository name, error) for the failed
+    ones. A failed listing ends the submission and is one of the failures.
+    """
+    results = []
+    failures = []
+    futures = []
+    already_done = 0
+    aborted = threading.Event()
+
+    def _check_failure(future):
+        if not future.cancelled() and future.exception():
+            aborted.set()
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(jobs, 1)) as executor:
+        try:
+            try:
+                for repo in repositories:
+                    if fail_fast and aborted.is_set():
+                        break
+                    if job and job.is_done(repo['name']):
+                        already_done += 1
+                        continue
+                    future = executor.submit(action, repo)
+                    if fail_fast:
+                        future.add_done_callback(_check_failure)
+                    futures.append((repo, future))
+            except requests.exceptions.RequestException as e:
+                # NOTE: the work already submitted still gets its summary.
+                print("Failed to list the repositories: %s" % e)
+                failures.append(("repository listing", e))
+
+            for index, (repo, future) in enumerate(futures):
+                try:
+                    results.append((repo, future.result()))
+                except concurrent.futures.CancelledError:
+                    continue
+                except requests.exceptions.RequestException as e:
+                    print("Failed on repository %s: %s" % (repo['name'], e))
+                    failures.append((repo['name'], e))
+                    if job:
+                        job.record(repo['name'], "failed", e)
+                    if fail_fast:
+                        for _, pending in futures[index + 1:]:
+                            pending.cancel()
+                else:
+                    if job:
+                        job.record(repo['name'], "ok")
+        except KeyboardInterrupt:
+            for _, pending in futures:
+                pending.cancel()
+            raise
+
+    skipped = sum(1 for _, future in futures if future.cancelled())
+    print("Finished: %s succeeded, %s failed, %s skipped" % (
+        len(results), len(failures), skipped))
+    if already_done:
+        print("%s repositories were already done by job %s" % (
+            already_done, job.job_id))
+    if failures:
+        print("Failed repositories: %s" % ", ".join(
+            name for name, _ in failures))
+    return results, failures
+
+
+def _make_visibility(api_url, headers, insecure, visibility, repo):
+    if repo.get('namespace'):
+        repo_name = "%s/%s" % (repo['namespace'], repo['name'])
+    else:
+        repo_name = "/%s" % repo['name']
+
+    report("Setting %s to repo %s" % (visibility, repo_name))
+
     body = {"visibility": visibility}
+    url = "%s/repository/%s/changevisibility" % (api_url, repo_name)
+    r = call_api("POST", url, headers, insecure, json=body)
+    r.raise_for_status()
+
+
+def report_unchanged(count, what, checks=0):
+    """Tell how many changes were skipped, and how many requests it took
+    to know, when the listing did not tell.
+    """
+    if checks:
+        print("Skipped %s changes: %s, after %s permission checks. Use "
+              "--force to send them anyway" % (count, what, checks))
+    elif count:
+        print("Avoided %s calls: %s. Use --force to send them anyway" % (
+            count, what))
+
+
+def _filter_visibility(repositories, visibility, unchanged):
+    is_public = visibility == "public"
     for repo in repositories:
-        if repo.get('namespace'):
-            repo_name = "%s/%s" % (repo['namespace'], repo['name'])
-        else:
-            repo_name = "/%s" % repo['name']
+        if repo.get('is_public') == is_public:
+            unchanged.append(repo['name'])
+            continue
+        yield repo
+
+
+def make_visibility(api_url, headers, insecure, repositories, visibility,
+                    jobs=DEFAULT_JOBS, fail_fast=False, job=None,
+                    force=False):
+    unchanged = []
+    if not force and visibility:
+        # NOTE: the listing already tells the current visibility
+        repositories = _filter_visibility(repositories, visibility,
+                                          unchanged)
+
+    action = functools.partial(_make_visibility, api_url, headers, insecure,
+                               visibility)
+    _, failures = run_bulk(action, repositories, jobs, fail_fast, job)
+    report_unchanged(len(unchanged), "repositories already %s" % visibility)
+    return failures
+
+
+def get_repo_permissions(api_url, headers, insecure, organization, repo_name,
+                         kind="user"):
+    url = "%s/repository/%s/%s/permissions/%s/" % (api_url, organization,
+                                                   repo_name, kind)
+    r = call_api("GET", url, headers, insecure)
+    r.raise_for_status()
+    permissions = r.json().get('permissions') or {}
+    return {name: permission['role']
+            for name, permission in permissions.items()}
 
-        print("Setting %s to repo %s" % (visibility, repo_name))
 
-        url = "%s/repository/%s/changevisibility" % (api_url, repo_name)
-        r = requests.post(url, json=body, headers=headers, verify=insecure)
+def set_repo_permission(api_url, headers, insecure, organization, repo_name,
+                        kind, name, role):
+    body = {"role": role}
+    url = "%s/repository/%s/%s/permissions/%s/%s" % (
+        api_url, organization, repo_name, kind, name)
+    r = call_api("PUT", url, headers, insecure, json=body)
+    if r.status_code != 201:
         r.raise_for_status()
 
 
+def get_user_repo_permission(api_url, headers, insecure, organization,
+                             repo_name, user):
+    url = "%s/repository/%s/%s/permissions/user/%s" % (
+        api_url, organization, repo_name, user)
+    r = call_api("GET", url, headers, insecure)
+    # NOTE: Quay answers 400 when the user has no permission on the repo
+    if r.status_code in (400, 404):
+        return
+    r.raise_for_status()
+    return r.json().get('role')
+
+
+def get_member_repositories(api_url, headers, insecure, organization, user):
+    """Return the names of the repositories of the organization where the
+    user has a permission of its own.
+    """
+    url = "%s/organization/%s/members/%s" % (api_url, organization, user)
+    r = call_api("GET", url, headers, insecure)
+    # NOTE: Quay answers 404 when the user has no permission in the org
+    if r.status_code in (400, 404):
+        return set()
+    r.raise_for_status()
+    return set(r.json().get('repositories') or [])
+
+
+def _set_user_repo_permission(api_url, headers, insecure, organization, user,
+                              with_permission, repo):
+    # NOTE: Quay does not list the roles of a user in bulk, only the
+    # repositories where the user has one need a check.
+    if with_permission is not None and repo['name'] in with_permission:
+        if get_user_repo_permission(api_url, headers, insecure, organization,
+                                    repo['name'], user) in ("write",
+                                                            "admin"):
+            return UNCHANGED
+
+    report("Adding %s write access to %s inside %s" % (user, repo['name'],
+                                                       organization))
+    set_repo_permission(api_url, headers, insecure, organization,
+                        repo['name'], "user", user, "write")
+
+
 def set_user_repo_permissions(api_url, headers, insecure, repos, organization,
-                              user):
+                              user, jobs=DEFAULT_JOBS, fail_fast=False,
+                              job=None, force=False):
     if not organization or not user:
         print("Can not continue. You need to provide --organization "
               "and --user parameters")
+        return
 
-    body = {"role": "write"}
+    with_permission = None
+    if not force:
+        with_permission = get_member_repositories(api_url, headers, insecure,
+                                                  organization, user)
+    action = functools.partial(_set_user_repo_permission, api_url, headers,
+                               insecure, organization, user, with_permission)
+    results, failures = run_bulk(action, repos, jobs, fail_fast, job)
+    report_unchanged(
+        sum(1 for _, result in results if result == UNCHANGED),
+        "%s already has write access" % user,
+        sum(1 for repo, _ in results
+            if with_permission and repo['name'] in with_permission))
+    return failures
+
+
+def _get_all_repo_permissions(api_url, headers, insecure, organization, repo):
+    return {kind: get_repo_permissions(api_url, headers, insecure,
+                                       organization, repo['name'], kind)
+            for kind in ("user", "team")}
+
+
+def audit_permissions(api_url, headers, insecure, organization, repos,
+                      jobs=DEFAULT_JOBS, fail_fast=False, output_format=None,
+                      fields=None):
+    """Print who has which role on the repositories of the organization.
+
+    The user and team permissions of the repositories are fetched in
+    parallel, then inverted into one record per principal and repository,
+    grouped by principal.
+    """
+    if not organization:
+        print("Can not continue: --organization param is required!")
+        return
 
-    for repo in repos:
-        print("Adding %s write access to %s inside %s" % (user, repo['name'],
-                                                          organization))
-        url = "%s/repository/%s/%s/permissions/user/%s" % (
-            api_url, organization, repo['name'], user)
-        r = requests.put(url, json=body, headers=headers, verify=insecure)
-        if r.status_code != 201:
-            r.raise_for_status()
+    action = functools.partial(_get_all_repo_permissions, api_url, headers,
+                               insecure, organization)
+    # NOTE: keep the messages out of the records written to stdout.
+    with contextlib.redirect_stdout(sys.stderr):
+        results, failures = run_bulk(action, repos, jobs, fail_fast)
+
+    index = collections.defaultdict(list)
+    for repo, permissions in results:
+        for kind, roles in permissions.items():
+            for principal, role in roles.items():
+                index[(kind, principal)].append((repo['name'], role))
+    print("%s principals have permissions on %s repositories of %s" % (
+        len(index), len(results), organization), file=sys.stderr)
+
+    output.write_records((
+        {"kind": kind, "principal": principal, "organization": organization,
+         "repository": repo_name, "role": role}
+        for (kind, principal), roles in sorted(index.items())
+        for repo_name, role in sorted(roles)),
+        output_format or "jsonl", fields)
+    return failures
 
 
 def get_quay_info(api_url, insecure):
     url = "%s/discovery" % api_url
-    r = requests.get(url, verify=insecure)
+    r = call_api("GET", url, insecure=insecure)
     r.raise_for_status()
     print(r.json())
 
@@ -241,51 +895,174 @@ def get_repository_images(api_url, headers, insecure, repository,
 
     for repo in repository:
         url = "%s/%s/image/" % (repo_url, repo)
-        r = requests.get(url, headers=headers, verify=insecure)
+        r = call_api("GET", url, headers, insecure)
         print(r.json())
 
 
-def create_repository(api_url, headers, insecure, organization, repositories):
+def iter_repository_images(api_url, headers, insecure, repository,
+                           organization):
+    repo_url = "%s/repository" % api_url
+    if organization:
+        repo_url = "%s/repository/%s" % (api_url, organization)
+
+    for repo in repository:
+        url = "%s/%s/image/" % (repo_url, repo)
+        for page in iter_pages(url, headers, insecure):
+            for image in page.get('images', []):
+                yield dict(image, repository=repo)
+
+
+def print_listing(listing, key, output_format=None, fields=None):
+    """Print a listing as a Python dict or, with output_format, its records.
+    """
+    if not output_format:
+        print(listing)
+        return
+    output.write_records((listing or {}).get(key, []), output_format,
+                         fields)
+
+
+def _create_repository(api_url, headers, insecure, organization, state,
+                       repository):
+    body = {
+        "repository": repository['name'],
+        "visibility": repository.get('visibility') or "public",
+        "namespace": organization,
+        "description": repository.get('description') or "None",
+        "repo_kind": "image"
+    }
+    report("Creating %s repository %s in organization %s" % (
+        body['visibility'], repository['name'], organization))
+
+    url = "%s/repository" % api_url
+    r = call_api("POST", url, headers, insecure, json=body)
+    r.raise_for_status()
+    if state:
+        state.add_repository(repository['name'])
+
+
+def create_repository(api_url, headers, insecure, organization, repositories,
+                      jobs=DEFAULT_JOBS, fail_fast=False, state=None,
+                      dry_run=False):
+    """Create the repositories that are missing in the organization.
+
+    The repositories are names, or dicts with a name and optionally a
+    visibility and a description. The repositories of the organization
+    are listed once to skip the existing ones, the others are created
+    in parallel. With dry_run, they are only printed. Returns the list of
+    (repository name, error) that failed.
+    """
     if not organization or not repositories:
         print("Can not continue: --organization and --repositories parameters "
               "are required!")
         return
-    for repository in repositories:
-        body = {
-            "repository": repository,
-            "visibility": "public",
-            "namespace": organization,
-            "description": "None",
-            "repo_kind": "image"
-        }
 
-        url = "%s/repository" % api_url
-        r = requests.post(url, json=body, headers=headers, verify=insecure)
-        r.raise_for_status()
+    state = state or OrgState(api_url, headers, insecure, organization)
+    missing = {}
+    existing = 0
+    for repository in repositories:
+        if isinstance(repository, str):
+            repository = {"name": repository}
+        if state.has_repository(repository['name']):
+            existing += 1
+        else:
+            missing.setdefault(repository['name'], repository)
+    if existing:
+        print("%s repositories already exist in %s" % (existing,
+                                                       organization))
+    if dry_run:
+        print("Plan for organization %s: %s repositories to create" % (
+            organization, len(missing)))
+        for repository in missing.values():
+            print("  - create repository %s (%s)" % (
+                repository['name'],
+                repository.get('visibility') or "private"))
+        return []
+
+    action = functools.partial(_create_repository, api_url, headers,
+                               insecure, organization, state)
+    _, failures = run_bulk(action, list(missing.values()), jobs, fail_fast)
+    return failures
+
+
+def load_repository_manifest(path, visibility=None):
+    """Return the repositories of a manifest file.
+
+    The manifest is a list of repositories, or a dict with the list in
+    repositories and the default visibility and description.
+    """
+    manifest = load_state_file(path)
+    if isinstance(manifest, list):
+        manifest = {"repositories": manifest}
+    defaults = {"visibility": manifest.get('visibility') or visibility,
+                "description": manifest.get('description')}
+    repositories = []
+    for repository in manifest.get('repositories') or []:
+        if isinstance(repository, str):
+            repository = {"name": repository}
+        repository = dict({key: value for key, value in defaults.items()
+                           if value}, **repository)
+        if repository.get('visibility') not in (None, "public", "private"):
+            print("Can not continue: the visibility of %s is public or "
+                  "private" % repository['name'])
+            sys.exit(1)
+        repositories.append(repository)
+    return repositories
 
 
-def list_repositories(api_url, headers, insecure, organization, visibility):
-    url = "%s/repository?" % api_url
+def iter_repositories(api_url, headers, insecure, organization=None,
+                      visibility=None, next_page=None, limit=None,
+                      max_pages=None):
+    params = {}
     if visibility == 'public':
-        url += "public=true"
+        params['public'] = "true"
 
     if organization:
-        url += "&namespace=%s" % organization
-
-    r = requests.get(url, headers=headers, verify=insecure)
-    r.raise_for_status()
-    return r.json()
+        params['namespace'] = organization
+
+    count = 0
+    token = next_page
+    for page in iter_pages("%s/repository" % api_url, headers, insecure,
+                           params, next_page, max_pages):
+        repositories = page.get('repositories') or []
+        for index, repo in enumerate(repositories, 1):
+            if visibility == 'private' and repo.get('is_public'):
+                continue
+            count += 1
+            yield repo
+            if limit and count >= limit:
+                # NOTE: resuming from the token of the current page repeats
+                # its first repositories.
+                resume = (token if index < len(repositories)
+                          else get_next_page_token(page))
+                if resume:
+                    logging.info("Reached the limit of %s repositories. To "
+                                 "continue, use: --next-page %s", limit,
+                                 resume)
+                return
+        token = get_next_page_token(page)
+
+
+def list_repositories(api_url, headers, insecure, organization, visibility,
+                      next_page=None, limit=None, max_pages=None):
+    return {"repositories": list(iter_repositories(
+        api_url, headers, insecure, organization, visibility, next_page,
+        limit, max_pages))}
 
 
 def expire_tag(api_url, headers, insecure, organization, tag, repositories,
-               days):
+               days, jobs=DEFAULT_JOBS, fail_fast=False, job=None,
+               force=False):
     return _tag_helper(api_url, headers, insecure, organization, tag,
-                       repositories, days, expire_tag=True)
+                       repositories, days, expire_tag=True, jobs=jobs,
+                       fail_fast=fail_fast, job=job, force=force)
 
 
-def restore_tag(api_url, headers, insecure, organization, tag, repositories):
+def restore_tag(api_url, headers, insecure, organization, tag, repositories,
+                jobs=DEFAULT_JOBS, fail_fast=False, job=None):
     return _tag_helper(api_url, headers, insecure, organization, tag,
-                       repositories, restore_tag=True)
+                       repositories, restore_tag=True, jobs=jobs,
+                       fail_fast=fail_fast, job=job)
 
 
 def _make_expire(api_url, headers, insecure, organization, tag, repository,
@@ -294,19 +1071,18 @@ def _make_expire(api_url, headers, insecure, organization, tag, repository,
         api_url, organization, repository['name'], tag)
 
     if days > 0:
-        now = datetime.datetime.utcnow()
-        tomorrow = now + datetime.timedelta(days=days)
-        body = {"expiration": int(tomorrow.timestamp())}
-        print("Setting experiation date to: %s, for project: %s in "
-              "organization: %s " % (body['expiration'], repository['name'],
-                                     organization))
+        expiration = time.time() + datetime.timedelta(
+            days=days).total_seconds()
+        body = {"expiration": int(expiration)}
+        report("Setting experiation date to: %s, for project: %s in "
+               "organization: %s " % (body['expiration'], repository['name'],
+                                      organization))
     else:
         body = {"expiration": None}
-        print("Canceling experiation date for project: %s in "
-              "organization: %s " % (repository['name'], organization))
+        report("Canceling experiation date for project: %s in "
+               "organization: %s " % (repository['name'], organization))
 
-    r = requests.put(url, json=body, headers=headers,
-                     verify=insecure)
+    r = call_api("PUT", url, headers, insecure, json=body)
     r.raise_for_status()
 
 
@@ -317,51 +1093,195 @@ def _make_restore(api_url, headers, insecure, organization, tag, repository,
     url = "%s/repository/%s/%s/tag/%s/restore" % (
         api_url, organization, repository['name'], tag)
 
-    print("Restoring tag: %s for project: %s in organization: %s " % (
+    report("Restoring tag: %s for project: %s in organization: %s " % (
         tag, repository['name'], organization))
-    r = requests.post(url, json=body, headers=headers,
-                      verify=insecure)
+    r = call_api("POST", url, headers, insecure, json=body)
     r.raise_for_status()
 
 
+def iter_repository_tags(api_url, headers, insecure, organization,
+                         repository, specific_tag=None, only_active=False,
+                         limit=TAG_PAGE_LIMIT):
+    """Yield the tags of the repository, one page of tags at a time.
+
+    With specific_tag, Quay only returns the entries of that tag name: the
+    current one and, unless only_active is set, its history, newest first.
+    """
+    url = "%s/repository/%s/%s/tag/" % (api_url, organization,
+                                        repository['name'])
+    params = {"limit": limit, "page": 1}
+    if specific_tag:
+        params['specificTag'] = specific_tag
+    if only_active:
+        params['onlyActiveTags'] = "true"
+
+    while True:
+        r = call_api("GET", url, headers, insecure, params=params)
+        r.raise_for_status()
+        available_tags = r.json()
+        for available_tag in available_tags.get('tags', []):
+            yield available_tag
+
+        if not available_tags.get('has_additional'):
+            return
+        params['page'] += 1
+
+
+def _is_tag_active(available_tag):
+    end_ts = available_tag.get('end_ts')
+    return not end_ts or end_ts > time.time()
+
+
+def _tag_repository(api_url, headers, insecure, organization, tag, days,
+                    expire_tag, restore_tag, force, repository):
+    # NOTE: ask Quay only for the requested tag. The newest entry is enough:
+    # it is the active tag, or the last deleted one when restoring.
+    tags = iter_repository_tags(api_url, headers, insecure, organization,
+                                repository, specific_tag=tag,
+                                only_active=not restore_tag, limit=1)
+    available_tag = next(tags, None)
+    tags.close()
+    if not available_tag or available_tag['name'] != tag:
+        return False
+
+    report("Found a tag %s in repository %s" % (tag, repository['name']))
+
+    if expire_tag and days is not None and days >= 0:
+        if not force and days == 0 and not available_tag.get('end_ts'):
+            return UNCHANGED
+        _make_expire(api_url, headers, insecure, organization, tag,
+                     repository, days)
+    elif restore_tag:
+        if _is_tag_active(available_tag):
+            report("The tag %s is still active in repository %s" % (
+                tag, repository['name']))
+            return UNCHANGED
+        else:
+            _make_restore(api_url, headers, insecure, organization,
+                          tag, repository, available_tag)
+    return True
+
+
 def _tag_helper(api_url, headers, insecure, organization, tag, repositories,
-                days=None, expire_tag=False, restore_tag=False):
+                days=None, expire_tag=False, restore_tag=False,
+                jobs=DEFAULT_JOBS, fail_fast=False, job=None, force=False):
 
     if not tag or not organization:
         print("Can not continue: --organization and --tag parameters "
               "are required!")
         return
 
-    missing_tags = []
-    for repository in repositories:
-        # get all available tags for that repository
-        url = "%s/repository/%s/%s/tag" % (api_url, organization,
-                                           repository['name'])
-        r = requests.get(url, headers=headers, verify=insecure)
-        r.raise_for_status()
-
-        available_tags = r.json()
-
-        if 'tags' not in available_tags:
-            print("Can't find any tag for repository %s" % repository['name'])
-            continue
-
-        for available_tag in available_tags['tags']:
-            if available_tag['name'] == tag:
-                print("Found a tag %s in repository %s" % (
-                    tag, repository['name']))
-
-                if expire_tag and days is not None and days >= 0:
-                    _make_expire(api_url, headers, insecure, organization, tag,
-                                 repository, days)
-                elif restore_tag:
-                    _make_restore(api_url, headers, insecure, organization,
-                                  tag, repository, available_tag)
-            else:
-                missing_tags.append(repository['name'])
+    action = functools.partial(_tag_repository, api_url, headers, insecure,
+                               organization, tag, days, expire_tag,
+                               restore_tag, force)
+    results, failures = run_bulk(action, repositories, jobs, fail_fast, job)
+    report_unchanged(
+        sum(1 for _, result in results if result == UNCHANGED),
+        "tag %s already %s" % (tag, "active" if restore_tag
+                               else "without expiration"))
 
+    missing_tags = [repo['name'] for repo, found in results if found is False]
     if missing_tags:
         print("Repos that image was skipped: %s" % set(missing_tags))
+    return failures
+
+
+def _plan_retention(api_url, headers, insecure, organization, policy,
+                    repository):
+    return policy.plan(iter_repository_tags(api_url, headers, insecure,
+                                            organization, repository,
+                                            only_active=True))
+
+
+def _expire_retention_tag(api_url, headers, insecure, organization, days,
+                          item):
+    _make_expire(api_url, headers, insecure, organization,
+                 item['tag']['name'], item['repository'], days)
+
+
+def apply_retention(api_url, headers, insecure, organization, repositories,
+                    policy, jobs=DEFAULT_JOBS, fail_fast=False, job=None,
+                    dry_run=False, output_format=None, fields=None,
+                    stream=None):
+    """Expire the tags of the repositories that the policy does not keep.
+
+    The tags of the repositories are listed and planned in parallel, then
+    the expirations are sent in parallel. With dry_run, the tags that would
+    be expired are written to stream instead.
+    """
+    plan = functools.partial(_plan_retention, api_url, headers, insecure,
+                             organization, policy)
+    results, failures = run_bulk(plan, repositories, jobs, fail_fast)
+
+    expirations = []
+    reclaimed_size = 0
+    reclaimed_count = 0
+    for repo, (expire, kept_digests) in results:
+        reclaimed = retention.get_reclaimed(expire, kept_digests)
+        reclaimed_size += sum(reclaimed.values())
+        reclaimed_count += len(reclaimed)
+        # NOTE: the job journal records the expired tags, as repo:tag
+        expirations.extend({"name": "%s:%s" % (repo['name'], tag['name']),
+                            "repository": repo, "tag": tag,
+                            "reclaimed": tag.get('manifest_digest') in
+                            reclaimed}
+                           for tag in expire)
+    print("%s: %s tags to expire in %s repositories of %s, reclaiming %s "
+          "manifests (%s bytes)" % (
+              policy.describe(), len(expirations), len(set(
+                  item['repository']['name'] for item in expirations)),
+              organization, reclaimed_count, reclaimed_size))
+
+    if dry_run:
+        output.write_records((
+            {"organization": organization,
+             "repository": item['repository']['name'],
+             "tag": item['tag']['name'],
+             "manifest_digest": item['tag'].get('manifest_digest'),
+             "size": item['tag'].get('size'),
+             "start_ts": item['tag'].get('start_ts'),
+             "reclaimed": item['reclaimed']} for item in expirations),
+            output_format or "table", fields, stream)
+        return failures
+
+    action = functools.partial(_expire_retention_tag, api_url, headers,
+                               insecure, organization, policy.grace_days)
+    _, expire_failures = run_bulk(action, expirations, jobs, fail_fast, job)
+    return failures + expire_failures
+
+
+def _add_repository_storage(api_url, headers, insecure, organization,
+                            storage_report, repository):
+    storage_report.add(organization, repository['name'], iter_repository_tags(
+        api_url, headers, insecure, organization, repository,
+        only_active=True))
+
+
+def report_storage(api_url, headers, insecure, organization, repositories,
+                   jobs=DEFAULT_JOBS, fail_fast=False, top=storage.DEFAULT_TOP,
+                   output_format=None, fields=None):
+    """Print the storage used by the active tags of the organization.
+
+    The tags of the repositories are walked in parallel, page by page, and
+    only the totals and the top largest repositories and tags are kept.
+    """
+    if not organization:
+        print("Can not continue: --organization param is required!")
+        return
+
+    if top < 1:
+        print("Can not continue: --top must be at least 1")
+        sys.exit(1)
+
+    storage_report = storage.StorageReport(top)
+    action = functools.partial(_add_repository_storage, api_url, headers,
+                               insecure, organization, storage_report)
+    # NOTE: keep the messages out of the records written to stdout.
+    with contextlib.redirect_stdout(sys.stderr):
+        _, failures = run_bulk(action, repositories, jobs, fail_fast)
+    output.write_records(storage_report.records(), output_format or "table",
+                         fields)
+    return failures
 
 
 ################
@@ -369,12 +1289,43 @@ def _tag_helper(api_url, headers, insecure, organization, tag, repositories,
 ################
 def get_organization_info(api_url, headers, insecure, organization):
     url = "%s/organization/%s" % (api_url, organization)
-    r = requests.get(url, headers=headers, verify=insecure)
+    r = call_api("GET", url, headers, insecure)
     if r.status_code == 200:
         print(r.json())
         return True
 
 
+def get_organization_teams(api_url, headers, insecure, organization):
+    url = "%s/organization/%s" % (api_url, organization)
+    r = call_api("GET", url, headers, insecure)
+    r.raise_for_status()
+    return r.json().get('teams') or {}
+
+
+def iter_changed_repositories(api_url, headers, insecure, organization,
+                              since):
+    """Yield the repositories named in the usage logs of the organization
+    since the since timestamp.
+    """
+    url = "%s/organization/%s/logs" % (api_url, organization)
+    # NOTE: Quay only takes a day, the logs of that day before since are
+    # dropped here.
+    params = {"starttime": datetime.datetime.utcfromtimestamp(
+        since).strftime("%m/%d/%Y")}
+    for page in iter_pages(url, headers, insecure, params):
+        for log in page.get('logs', []):
+            repo = (log.get('metadata') or {}).get('repo')
+            if not repo:
+                continue
+            try:
+                logged = email_utils.parsedate_to_datetime(
+                    log['datetime']).timestamp()
+            except (KeyError, TypeError, ValueError):
+                logged = None
+            if logged is None or logged >= since:
+                yield repo
+
+
 def create_organization(api_url, headers, insecure, organization):
     if not organization:
         print("Can not continue: --organization parameter is required")
@@ -386,7 +1337,7 @@ def create_organization(api_url, headers, insecure, organization):
 
     url = "%s/organization/" % api_url
     body = {"name": organization}
-    r = requests.post(url, json=body, headers=headers, verify=insecure)
+    r = call_api("POST", url, headers, insecure, json=body)
     if r.status_code != 201:
         print("something happend on creating organization!")
         r.raise_for_status()
@@ -395,44 +1346,37 @@ def create_organization(api_url, headers, insecure, organization):
 #########
 # ROBOT #
 #########
-def get_robots_in_organization(api_url, headers, insecure, organization):
+def get_robots_in_organization(api_url, headers, insecure, organization,
+                               token=True, permissions=True):
     if not organization:
         print("Can not continue: --organization param is required!")
         return
 
-    url = "%s/organization/%s/robots?token=true&permissions=true" % (
-        api_url, organization)
-    r = requests.get(url, headers=headers, verify=insecure)
+    url = "%s/organization/%s/robots?token=%s&permissions=%s" % (
+        api_url, organization, str(token).lower(), str(permissions).lower())
+    r = call_api("GET", url, headers, insecure)
     r.raise_for_status()
     return r.json()
 
 
-def _is_robot_already_created(organization, robot, current_robots):
-    if not current_robots or 'robots' not in current_robots:
-        return
-
-    for r in current_robots['robots']:
-        if "%s+%s" % (organization, robot) == r['name']:
-            print("The robot %s already exists in the organization!" % robot)
-            return True
-
-
-def create_robot(api_url, headers, insecure, organization, robot):
+def create_robot(api_url, headers, insecure, organization, robot,
+                 state=None):
     if not organization or not robot:
         print("Can not continue. Organization param and robot name "
               "is required!")
         return
-    current_robots = get_robots_in_organization(api_url, headers, insecure,
-                                                organization)
-    if _is_robot_already_created(organization, robot, current_robots):
+    state = state or OrgState(api_url, headers, insecure, organization)
+    if state.has_robot(robot):
+        print("The robot %s already exists in the organization!" % robot)
         return
 
     url = "%s/organization/%s/robots/%s" % (api_url, organization, robot)
     body = {"unstructured_metadata": {},
             "description": "Robot created by quay tool"}
-    r = requests.put(url, json=body, headers=headers, verify=insecure)
+    r = call_api("PUT", url, headers, insecure, json=body)
     if r.status_code != 201:
         r.raise_for_status()
+    state.add_robot(robot)
     return r.json()
 
 
@@ -442,7 +1386,7 @@ def create_robot(api_url, headers, insecure, organization, robot):
 def get_team_members(api_url, headers, insecure, organization, team):
     url = "%s/organization/%s/team/%s/members" % (api_url, organization,
                                                   team)
-    r = requests.get(url, headers=headers, verify=insecure)
+    r = call_api("GET", url, headers, insecure)
     if r.status_code == 404:
         print("Can not find team or you don't have enough permissions")
         return
@@ -450,13 +1394,14 @@ def get_team_members(api_url, headers, insecure, organization, team):
     return r.json()
 
 
-def create_team(api_url, headers, insecure, organization, team):
+def create_team(api_url, headers, insecure, organization, team, state=None):
     if not organization or not team:
         print("Can not continue: --organization and --team parameters "
               "are required!")
         return
 
-    if get_team_members(api_url, headers, insecure, organization, team):
+    state = state or OrgState(api_url, headers, insecure, organization)
+    if state.has_team(team):
         print("Team seems that already exists!")
         return
 
@@ -466,36 +1411,28 @@ def create_team(api_url, headers, insecure, organization, team):
     }
 
     url = "%s/organization/%s/team/%s" % (api_url, organization, team)
-    r = requests.put(url, json=body, headers=headers, verify=insecure)
+    r = call_api("PUT", url, headers, insecure, json=body)
     r.raise_for_status()
+    state.add_team(team)
 
 
-def is_member_in_team(members, user):
-    if 'members' not in members:
-        return
-
-    for member in members['members']:
-        if member['name'] == user:
-            return user
-
-
-def add_member(api_url, headers, insecure, organization, team, user):
+def add_member(api_url, headers, insecure, organization, team, user,
+               state=None):
     if not organization or not team or not user:
         print("Can not continue: --organization, --team and --user parameters "
               "are required!")
         return
 
-    team_members = get_team_members(api_url, headers, insecure, organization,
-                                    team)
-
-    if is_member_in_team(team_members, user):
+    state = state or OrgState(api_url, headers, insecure, organization)
+    if state.is_member(team, user):
         print("User already in the team")
         return
 
     url = "%s/organization/%s/team/%s/members/%s" % (api_url, organization,
                                                      team, user)
-    r = requests.put(url, headers=headers, verify=insecure)
+    r = call_api("PUT", url, headers, insecure)
     r.raise_for_status()
+    state.add_member(team, user)
 
 
 def regenerate_token(api_url, headers, insecure, organization, robot):
@@ -507,7 +1444,7 @@ def regenerate_token(api_url, headers, insecure, organization, robot):
     url = "%s/organization/%s/robots/%s/regenerate" % (api_url, organization,
                                                        robot)
     body = {}
-    r = requests.put(url, json=body, headers=headers, verify=insecure)
+    r = call_api("PUT", url, headers, insecure, json=body)
     if r.status_code != 201:
         r.raise_for_status()
     return r.json()
@@ -519,32 +1456,20 @@ def get_prototypes_in_org(api_url, headers, insecure, organization):
         return
     url = "%s/organization/%s/prototypes" % (
         api_url, organization)
-    r = requests.get(url, headers=headers, verify=insecure)
+    r = call_api("GET", url, headers, insecure)
     r.raise_for_status()
     return r.json()
 
 
-def is_prototype_in_org(prototypes, user, team):
-    if 'prototypes' not in prototypes:
-        return
-
-    for prototype in prototypes['prototypes']:
-        if prototype['delegate']['name'] == user or prototype['delegate'][
-                'name'] == team:
-            return user or team
-
-
 def create_prototype_in_org(api_url, headers, insecure, organization, user,
-                            team):
+                            team, state=None):
     if not organization or (not user and not team):
         print("Can not continue: --organization and --user or --team "
               "parameters are required!")
         return
 
-    prototypes = get_prototypes_in_org(api_url, headers, insecure,
-                                       organization)
-
-    if is_prototype_in_org(prototypes, user, team):
+    state = state or OrgState(api_url, headers, insecure, organization)
+    if state.has_prototype(user, team):
         print("User or team already got an prototype")
         return
 
@@ -561,8 +1486,1177 @@ def create_prototype_in_org(api_url, headers, insecure, organization, user,
         body['delegate']['kind'] = "team"
 
     url = "%s/organization/%s/prototypes" % (api_url, organization)
-    r = requests.post(url, json=body, headers=headers, verify=insecure)
+    r = call_api("POST", url, headers, insecure, json=body)
     r.raise_for_status()
+    state.add_prototype(body['delegate']['name'])
+
+
+######################
+# ORGANIZATION STATE #
+######################
+class OrgState:
+    """Index of the repositories, robots, teams, members and prototypes of an
+    organization.
+
+    Each kind is listed once, on first use, with the lightest endpoint.
+    The create functions keep the index up to date, so provisioning many
+    items only does one listing per kind.
+    """
+
+    def __init__(self, api_url, headers, insecure, organization):
+        self.api_url = api_url
+        self.headers = headers
+        self.insecure = insecure
+        self.organization = organization
+        self._robots = None
+        self._teams = None
+        self._members = {}
+        self._prototypes = None
+        self._repositories = None
+        self._lock = threading.RLock()
+        self.created = time.monotonic()
+
+    def _common(self):
+        return (self.api_url, self.headers, self.insecure, self.organization)
+
+    @property
+    def robots(self):
+        with self._lock:
+            if self._robots is None:
+                robots = get_robots_in_organization(
+                    *self._common(), token=False, permissions=False) or {}
+                self._robots = {robot['name']
+                                for robot in robots.get('robots', [])}
+            return self._robots
+
+    @property
+    def teams(self):
+        with self._lock:
+            if self._teams is None:
+                self._teams = set(get_organization_teams(*self._common()))
+            return self._teams
+
+    @property
+    def prototypes(self):
+        with self._lock:
+            if self._prototypes is None:
+                prototypes = get_prototypes_in_org(*self._common()) or {}
+                self._prototypes = {
+                    prototype['delegate']['name']
+                    for prototype in prototypes.get('prototypes', [])}
+            return self._prototypes
+
+    @property
+    def repositories(self):
+        with self._lock:
+            if self._repositories is None:
+                self._repositories = {repo['name'] for repo in
+                                      iter_repositories(*self._common())}
+            return self._repositories
+
+    def members(self, team):
+        with self._lock:
+            if team not in self._members:
+                members = {}
+                # NOTE: no need to ask for members of a team that is
+                # known to be missing.
+                if self._teams is None or team in self._teams:
+                    members = get_team_members(*self._common(), team) or {}
+                self._members[team] = {
+                    member['name'] for member in members.get('members', [])}
+            return self._members[team]
+
+    def has_robot(self, robot):
+        return "%s+%s" % (self.organization, robot) in self.robots
+
+    def add_robot(self, robot):
+        with self._lock:
+            self.robots.add("%s+%s" % (self.organization, robot))
+
+    def has_team(self, team):
+        return team in self.teams
+
+    def add_team(self, team):
+        with self._lock:
+            self.teams.add(team)
+            self._members.setdefault(team, set())
+
+    def is_member(self, team, user):
+        return user in self.members(team)
+
+    def add_member(self, team, user):
+        with self._lock:
+            self.members(team).add(user)
+
+    def has_repository(self, repository):
+        return repository in self.repositories
+
+    def add_repository(self, repository):
+        with self._lock:
+            if self._repositories is not None:
+                self._repositories.add(repository)
+
+    def has_prototype(self, user, team):
+        return bool({user, team} & self.prototypes)
+
+    def add_prototype(self, name):
+        with self._lock:
+            self.prototypes.add(name)
+
+
+#########
+# BATCH #
+#########
+def _batch_create_repository(api_url, headers, insecure, organization,
+                             repository, state=None):
+    if not isinstance(repository, list):
+        repository = [repository]
+    failures = create_repository(api_url, headers, insecure, organization,
+                                 repository, jobs=1, state=state)
+    if failures:
+        raise failures[0][1]
+
+
+# Batch operation name: (function, item keys given as arguments, whether the
+# function accepts an OrgState). All the keys are required, a tuple of keys
+# requires at least one of them.
+BATCH_OPERATIONS = {
+    "create-organization": (create_organization, ["organization"], False),
+    "create-repository": (_batch_create_repository,
+                          ["organization", "repository"], True),
+    "create-robot": (create_robot, ["organization", "robot"], True),
+    "regenerate-token": (regenerate_token, ["organization", "robot"], False),
+    "create-team": (create_team, ["organization", "team"], True),
+    "add-member": (add_member, ["organization", "team", "user"], True),
+    "create-prototype": (create_prototype_in_org,
+                         ["organization", ("user", "team")], True),
+}
+
+
+def iter_batch_items(path):
+    f = sys.stdin if path == "-" else open(path)
+    try:
+        for number, line in enumerate(f, 1):
+            if line.strip() and not line.lstrip().startswith("#"):
+                yield number, line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def get_org_state(api_url, headers, insecure, states, states_lock,
+                  organization):
+    with states_lock:
+        if organization not in states:
+            states[organization] = OrgState(api_url, headers, insecure,
+                                            organization)
+        return states[organization]
+
+
+def run_operation(api_url, headers, insecure, states, states_lock, item,
+                  dry_run=False):
+    """Run one batch operation and return its result as a dict.
+
+    With dry_run, the operation is only checked and gets the planned status.
+    """
+    result = {}
+    if not isinstance(item, dict) or item.get('op') not in BATCH_OPERATIONS:
+        result['status'] = "error"
+        result['error'] = "Unknown operation, known ones are: %s" % (
+            ", ".join(sorted(BATCH_OPERATIONS)))
+        return result
+    result['op'] = item['op']
+    func, keys, with_state = BATCH_OPERATIONS[item['op']]
+    names = [key if isinstance(key, tuple) else (key,) for key in keys]
+    missing = [" or ".join(group) for group in names
+               if not any(item.get(name) for name in group)]
+    if missing:
+        # NOTE: the functions only print a message on missing parameters,
+        # which would be reported as a success.
+        result['status'] = "error"
+        result['error'] = "Missing parameters: %s" % ", ".join(missing)
+        return result
+    if dry_run:
+        result['status'] = "planned"
+        return result
+    args = [item.get(name) for group in names for name in group]
+    kwargs = {}
+    if with_state:
+        kwargs['state'] = get_org_state(api_url, headers, insecure, states,
+                                        states_lock, item.get('organization'))
+    try:
+        result['result'] = func(api_url, headers, insecure, *args, **kwargs)
+        result['status'] = "ok"
+    except (ValueError, requests.exceptions.RequestException) as e:
+        result['status'] = "error"
+        result['error'] = str(e)
+    return result
+
+
+def _run_batch_item(api_url, headers, insecure, states, states_lock, dry_run,
+                    number, line):
+    result = {"line": number}
+    try:
+        item = json.loads(line)
+    except ValueError as e:
+        result['status'] = "error"
+        result['error'] = str(e)
+        return result
+    result.update(run_operation(api_url, headers, insecure, states,
+                                states_lock, item, dry_run))
+    return result
+
+
+def run_batch(api_url, headers, insecure, path, jobs=DEFAULT_JOBS,
+              dry_run=False):
+    """Run the JSON Lines operations of path and stream their results.
+
+    Consecutive operations of the same kind run in parallel. When the kind
+    changes, the previous operations are finished first, so that for
+    example members are added once their team got created. With dry_run,
+    the operations are only checked.
+    """
+    out = sys.stdout
+    states = {}
+    states_lock = threading.Lock()
+    failures = []
+
+    def flush(pending):
+        for future in concurrent.futures.as_completed(pending):
+            result = future.result()
+            if result['status'] == "error":
+                failures.append((result['line'], result.get('error')))
+            out.write(json.dumps(result, default=str) + "\n")
+            out.flush()
+        pending.clear()
+
+    # NOTE: the functions print their progress, keep stdout for results.
+    with contextlib.redirect_stdout(sys.stderr), \
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(jobs, 1)) as executor:
+        pending = []
+        current_op = None
+        for number, line in iter_batch_items(path):
+            try:
+                op = json.loads(line).get('op')
+            except (ValueError, AttributeError):
+                op = None
+            if op != current_op:
+                flush(pending)
+                current_op = op
+            pending.append(executor.submit(
+                _run_batch_item, api_url, headers, insecure, states,
+                states_lock, dry_run, number, line))
+        flush(pending)
+
+    return failures
+
+
+#############
+# RECONCILE #
+#############
+def load_state_file(path):
+    if path == "-":
+        content = sys.stdin.read()
+    else:
+        with open(path) as f:
+            content = f.read()
+
+    if path.endswith((".yaml", ".yml")):
+        if yaml is None:
+            print("Can not continue: PyYAML is required to read %s" % path)
+            sys.exit(1)
+        return yaml.safe_load(content) or {}
+    return json.loads(content)
+
+
+def _plan_action(description, func, *args):
+    return {"name": description, "run": functools.partial(func, *args)}
+
+
+def _get_current_permissions(api_url, headers, insecure, organization, repos,
+                             jobs):
+    def fetch(repo_name):
+        return _get_all_repo_permissions(api_url, headers, insecure,
+                                         organization, {"name": repo_name})
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(jobs, 1)) as executor:
+        return dict(zip(repos, executor.map(fetch, repos)))
+
+
+def plan_state(api_url, headers, insecure, organization, desired,
+               jobs=DEFAULT_JOBS):
+    """Compare the desired state with Quay and return the needed actions.
+
+    The actions are grouped in phases: a phase only depends on the
+    previous ones, so the actions of a phase can run in parallel.
+    Nothing that is missing from the desired state is removed.
+    """
+    creations, updates, permissions = [], [], []
+    common = (api_url, headers, insecure, organization)
+    state = OrgState(*common)
+
+    current_repos = {repo['name']: repo for repo in get_organization_details(
+        api_url, headers, insecure, organization, [], [])}
+    desired_repos = desired.get('repositories') or []
+    with_permissions = [repo['name'] for repo in desired_repos
+                        if repo.get('permissions') and
+                        repo['name'] in current_repos]
+    current_permissions = _get_current_permissions(
+        api_url, headers, insecure, organization, with_permissions, jobs)
+
+    for repo in desired_repos:
+        name = repo['name']
+        current = current_repos.get(name)
+        if not current:
+            visibility = repo.get('visibility') or "public"
+            creations.append(_plan_action(
+                "create %s repository %s" % (visibility, name),
+                _create_repository, *common, state,
+                {"name": name, "visibility": visibility,
+                 "description": repo.get('description')}))
+            current = {"name": name, "is_public": visibility == "public"}
+
+        visibility = repo.get('visibility')
+        if visibility and current.get('is_public') != (
+                visibility == "public"):
+            updates.append(_plan_action(
+                "set %s visibility to %s" % (name, visibility),
+                _make_visibility, api_url, headers, insecure, visibility,
+                {"namespace": organization, "name": name}))
+
+        current_perms = current_permissions.get(name, {})
+        for kind in ("user", "team"):
+            for principal, role in (repo.get('permissions') or {}).get(
+                    "%ss" % kind, {}).items():
+                if current_perms.get(kind, {}).get(principal) != role:
+                    permissions.append(_plan_action(
+                        "give %s %s %s role on %s" % (
+                            kind, principal, role, name),
+                        set_repo_permission, *common, name, kind,
+                        principal, role))
+
+    for robot in desired.get('robots') or []:
+        if not state.has_robot(robot):
+            creations.append(_plan_action(
+                "create robot %s" % robot, create_robot, *common, robot,
+                state))
+
+    for team, spec in (desired.get('teams') or {}).items():
+        if not state.has_team(team):
+            creations.append(_plan_action(
+                "create team %s" % team, create_team, *common, team, state))
+        for member in (spec or {}).get('members') or []:
+            if not state.is_member(team, member):
+                updates.append(_plan_action(
+                    "add %s to team %s" % (member, team), add_member,
+                    *common, team, member, state))
+
+    for prototype in desired.get('prototypes') or []:
+        user, team = prototype.get('user'), prototype.get('team')
+        if not state.has_prototype(user, team):
+            updates.append(_plan_action(
+                "create prototype for %s" % (user or team),
+                create_prototype_in_org, *common, user, team, state))
+
+    return [phase for phase in (creations, updates, permissions) if phase]
+
+
+def apply_state(api_url, headers, insecure, organization, path,
+                jobs=DEFAULT_JOBS, fail_fast=False, dry_run=False):
+    desired = load_state_file(path)
+    organization = desired.get('organization') or organization
+    if not organization:
+        print("Can not continue: the organization needs to be set in the "
+              "state file or with --organization parameter")
+        return
+
+    start = time.monotonic()
+    phases = plan_state(api_url, headers, insecure, organization, desired,
+                        jobs)
+    planned = time.monotonic()
+
+    actions = sum(len(phase) for phase in phases)
+    print("Plan for organization %s: %s changes (computed in %.2fs)" % (
+        organization, actions, planned - start))
+    for phase in phases:
+        for action in phase:
+            print("  - %s" % action['name'])
+
+    failures = []
+    if dry_run or not actions:
+        return failures
+
+    for phase in phases:
+        _, phase_failures = run_bulk(lambda action: action['run'](), phase,
+                                     jobs, fail_fast)
+        failures += phase_failures
+        if phase_failures and fail_fast:
+            break
+    print("Applied in %.2fs" % (time.monotonic() - planned))
+    return failures
+
+
+###########
+# FAN-OUT #
+###########
+def split_organizations(value):
+    return [name.strip() for name in (value or "").split(",")
+            if name.strip()]
+
+
+def is_pattern(name):
+    return any(char in name for char in "*?[")
+
+
+def get_user_organizations(api_url, headers, insecure):
+    url = "%s/user/" % api_url
+    r = call_api("GET", url, headers, insecure)
+    r.raise_for_status()
+    return [org['name'] for org in r.json().get('organizations', [])]
+
+
+def resolve_organizations(api_url, headers, insecure, patterns):
+    """Return the organizations named or matched by a glob of patterns.
+
+    The organizations of the token user are only listed for the globs.
+    """
+    organizations = []
+    available = None
+    for pattern in patterns:
+        matches = [pattern]
+        if is_pattern(pattern):
+            if available is None:
+                available = get_user_organizations(api_url, headers,
+                                                   insecure)
+            matches = fnmatch.filter(available, pattern)
+            if not matches:
+                logging.warning("No organization matches %s on %s",
+                                pattern, api_url)
+        for organization in matches:
+            if organization not in organizations:
+                organizations.append(organization)
+    return organizations
+
+
+def load_registries(path, args):
+    """Return the registries described by the --registries file."""
+    try:
+        config = load_state_file(path)
+    except (OSError, ValueError) as e:
+        print("Can not read %s: %s" % (path, e))
+        sys.exit(1)
+
+    registries = []
+    for registry in config.get('registries') or []:
+        api_url = (registry.get('api_url') or "").rstrip("/")
+        if '/api/v' not in api_url:
+            print("Can not continue: every registry needs an api_url with "
+                  "the API endpoint")
+            sys.exit(1)
+        token = registry.get('token')
+        if registry.get('token_file'):
+            with open(os.path.expanduser(registry['token_file'])) as f:
+                token = f.read().strip()
+        organizations = registry.get('organizations') or []
+        if isinstance(organizations, str):
+            organizations = split_organizations(organizations)
+        registries.append({
+            "name": registry.get('name') or urllib.parse.urlparse(
+                api_url).netloc,
+            "api_url": api_url,
+            "headers": gen_headers(token) if token else None,
+            # NOTE: like the --insecure option, False means skip the checks
+            "insecure": not registry.get('insecure', False),
+            "organizations": organizations,
+            "jobs": registry.get('jobs') or args.jobs,
+            "max_rps": registry.get('max_rps') or args.max_rps,
+        })
+    if not registries:
+        print("Can not continue: no registries in %s" % path)
+        sys.exit(1)
+    return registries
+
+
+def get_targets(registries, patterns=None):
+    """Return a target per registry and organization to work on.
+
+    The patterns given on the command line replace the organizations of
+    the registries.
+    """
+    targets = []
+    for registry in registries:
+        try:
+            organizations = resolve_organizations(
+                registry['api_url'], registry['headers'],
+                registry['insecure'], patterns or registry['organizations'])
+        except requests.exceptions.RequestException as e:
+            print("Can not list the organizations of %s: %s" % (
+                registry['name'], e))
+            sys.exit(1)
+        targets.extend(dict(registry, organization=organization)
+                       for organization in organizations)
+    return targets
+
+
+def _run_target(args, action, job_id, target):
+    result = {"registry": target['name'],
+              "organization": target['organization'],
+              "status": "ok", "failed": 0, "error": None}
+    report("Running %s on %s in %s" % (
+        action, target['organization'], target['name']))
+    try:
+        changes = get_changes(args, target['api_url'], target['headers'],
+                              target['insecure'], target['organization'],
+                              action)
+        job, repos = start_job(args, target['headers'], action, target,
+                               job_id, changes)
+        with contextlib.closing(job):
+            failures = run_bulk_action(
+                args, target['api_url'], target['headers'],
+                target['insecure'], target['organization'], repos, job,
+                target['jobs'])
+        finish_job(job, failures, args.dry_run)
+        save_changes(changes, failures, args.dry_run)
+    except requests.exceptions.RequestException as e:
+        result['status'] = "error"
+        result['error'] = str(e)
+    except SystemExit:
+        result['status'] = "error"
+        result['error'] = "aborted, see the messages above"
+    else:
+        if failures:
+            result['status'] = "failed"
+            result['failed'] = len(failures)
+    return result
+
+
+def fan_out_bulk_action(args, targets):
+    """Run the bulk action of args on every target and print a report.
+
+    Every target has its own job journal, named after the job of the run,
+    so --resume with the job id of the run resumes all the targets.
+    """
+    action = get_bulk_action(args)
+    job_id = args.resume or journal.new_job_id()
+    print("Job %s: to resume it, use --resume %s" % (job_id, job_id))
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(args.max_targets, 1)) as executor:
+        results = list(executor.map(functools.partial(
+            _run_target, args, action, job_id), targets))
+
+    print("Finished on %s organizations:" % len(results))
+    output.write_records(results, args.output or "table", args.fields)
+    return [("%s/%s" % (result['registry'], result['organization']),
+             result['error'] or result['failed'])
+            for result in results if result['status'] != "ok"]
+
+
+def _list_target(args, target):
+    try:
+        return [dict(repo, registry=target['name'])
+                for repo in iter_repositories(
+                    target['api_url'], target['headers'], target['insecure'],
+                    target['organization'], args.visibility, None,
+                    args.limit, args.max_pages)], None
+    except requests.exceptions.RequestException as e:
+        return [], e
+
+
+def fan_out_listing(args, targets):
+    """Print the repositories of every target, in the order of targets."""
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(args.max_targets, 1)) as executor:
+        listings = executor.map(functools.partial(_list_target, args),
+                                targets)
+        records = []
+        for target, (repos, error) in zip(targets, listings):
+            if error:
+                logging.error("Can not list %s in %s: %s",
+                              target['organization'], target['name'], error)
+                failures.append((target['organization'], error))
+            records.extend(repos)
+    output.write_records(records, args.output or "jsonl", args.fields)
+    return failures
+
+
+##################
+# TOKEN ROTATION #
+##################
+class TokenSink:
+    """JSON Lines output of the regenerated robot tokens.
+
+    The file is only readable by its owner and new tokens are appended,
+    so a resumed rotation adds to it. Every token is synced to disk before
+    its robot is recorded as done by the job. Without path, the tokens
+    are written to stdout.
+    """
+
+    def __init__(self, path=None, stream=None):
+        self._lock = threading.Lock()
+        self.path = path
+        self.count = 0
+        if path:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            # NOTE: the file may already exist with wider permissions.
+            os.fchmod(fd, 0o600)
+            self.stream = os.fdopen(fd, "a")
+        else:
+            self.stream = stream or sys.stdout
+
+    def write(self, record):
+        with self._lock:
+            self.stream.write(json.dumps(record) + "\n")
+            self.stream.flush()
+            if self.path:
+                os.fsync(self.stream.fileno())
+            self.count += 1
+
+    def close(self):
+        if self.path:
+            self.stream.close()
+
+
+def get_robot_selector(args):
+    patterns = [re.compile(pattern) for pattern in args.robot_pattern]
+    patterns += [re.compile(fnmatch.translate(glob))
+                 for glob in args.robot_glob]
+    if args.robot:
+        patterns.append(re.compile("^%s$" % re.escape(args.robot)))
+    return lambda name: not patterns or any(pattern.search(name)
+                                            for pattern in patterns)
+
+
+def _list_rotated_robots(selector, target):
+    # NOTE: the robots are listed without their token and permissions.
+    robots = get_robots_in_organization(
+        target['api_url'], target['headers'], target['insecure'],
+        target['organization'], token=False, permissions=False)
+    selected = []
+    for robot in robots.get('robots', []):
+        short_name = robot['name'].split("+", 1)[-1]
+        if selector(short_name):
+            selected.append({
+                "name": "%s/%s" % (target['name'], robot['name']),
+                "registry": target['name'],
+                "organization": target['organization'],
+                "robot": short_name})
+    return selected
+
+
+def _rotate_token(registries, sink, robot):
+    registry = registries[robot['registry']]
+    report("Regenerating the token of %s+%s in %s" % (
+        robot['organization'], robot['robot'], robot['registry']))
+    result = regenerate_token(registry['api_url'], registry['headers'],
+                              registry['insecure'], robot['organization'],
+                              robot['robot'])
+    sink.write({"registry": robot['registry'],
+                "organization": robot['organization'],
+                "robot": result.get('name') or "%s+%s" % (
+                    robot['organization'], robot['robot']),
+                "token": result.get('token'),
+                "rotated": int(time.time())})
+
+
+def rotate_tokens(args, targets):
+    """Regenerate the tokens of the robots selected by args in every target.
+
+    The robots of the targets are listed once, then their tokens are
+    regenerated in parallel and written to the --tokens-file sink. The job
+    journal records the robots done, so --resume only rotates the others.
+    Tokens are never printed with the progress messages.
+    """
+    if args.dry_run:
+        return _rotate_tokens(args, targets)
+    sink = TokenSink(args.tokens_file, sys.stdout)
+    # NOTE: keep the messages out of the tokens written to stdout.
+    messages = sys.stdout if args.tokens_file else sys.stderr
+    with contextlib.closing(sink), contextlib.redirect_stdout(messages):
+        failures = _rotate_tokens(args, targets, sink)
+        if args.tokens_file:
+            print("Wrote %s tokens to %s" % (sink.count, args.tokens_file))
+    return failures
+
+
+def _rotate_tokens(args, targets, sink=None):
+    selector = get_robot_selector(args)
+    selectors = (args.robot_pattern + args.robot_glob +
+                 ([args.robot] if args.robot else []))
+    action = "rotate-tokens %s on %s" % (
+        " or ".join(selectors) or "all robots",
+        ", ".join("%s/%s" % (target['name'], target['organization'])
+                  for target in targets))
+    try:
+        job = journal.Journal(action, args.resume)
+    except (journal.JournalError, OSError) as e:
+        print("Can not continue: %s" % e)
+        sys.exit(1)
+    print("Job %s: to resume it, use --resume %s" % (job.job_id, job.job_id))
+
+    robots = job.load_repositories()
+    if robots is None:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(args.max_targets, 1)) as executor:
+            listings = executor.map(
+                functools.partial(_list_rotated_robots, selector), targets)
+            try:
+                robots = list(job.track_repositories(
+                    itertools.chain.from_iterable(listings)))
+            except requests.exceptions.RequestException as e:
+                job.remove()
+                print("Can not list the robots: %s" % e)
+                sys.exit(1)
+    else:
+        print("Reusing the %s robots listed by the job" % len(robots))
+    print("%s robots selected in %s organizations" % (len(robots),
+                                                      len(targets)))
+
+    if not sink:
+        job.remove()
+        output.write_records(
+            ({key: robot[key] for key in ("registry", "organization",
+                                          "robot")} for robot in robots),
+            args.output or "table", args.fields)
+        return
+
+    registries = {target['name']: target for target in targets}
+    with contextlib.closing(job):
+        _, failures = run_bulk(
+            functools.partial(_rotate_token, registries, sink), robots,
+            args.jobs, args.fail_fast, job)
+    finish_job(job, failures)
+    return failures
+
+
+#########
+# SERVE #
+#########
+def _required(params, *keys):
+    if not isinstance(params, dict):
+        raise server.ApiError(400, "Expected a JSON object")
+    missing = [key for key in keys if not params.get(key)]
+    if missing:
+        raise server.ApiError(400, "Missing parameters: %s" % ", ".join(
+            missing))
+    return [params[key] for key in keys]
+
+
+class Service:
+    """The quaytool operations served by the --serve daemon.
+
+    The connection pool, the scheduler and the organization states live as
+    long as the daemon. Identical listings asked at the same time share one
+    fetch from Quay.
+    """
+
+    def __init__(self, api_url, headers, insecure, jobs=DEFAULT_JOBS,
+                 fail_fast=False, max_pages=None):
+        self.api_url = api_url
+        self.headers = headers
+        self.insecure = insecure
+        self.jobs = jobs
+        self.fail_fast = fail_fast
+        self.max_pages = max_pages
+        self.states = {}
+        self.states_lock = threading.Lock()
+        self.coalescer = server.Coalescer()
+
+    def _common(self):
+        return (self.api_url, self.headers, self.insecure)
+
+    def invalidate(self, organization=None):
+        with self.states_lock:
+            if organization:
+                self.states.pop(organization, None)
+            else:
+                self.states.clear()
+
+    def _expire_states(self):
+        now = time.monotonic()
+        with self.states_lock:
+            for organization, state in list(self.states.items()):
+                if now - state.created > STATE_TTL:
+                    del self.states[organization]
+
+    def _listing(self, name, query, func):
+        key = (name, tuple(sorted(query.items())))
+        return self.coalescer.do(key, func)
+
+    def health(self, query, body):
+        return {"status": "ok", "organizations": sorted(
+            organization for organization in self.states if organization)}
+
+    def repositories(self, query, body):
+        limit = int(query['limit']) if query.get('limit') else None
+        return self._listing("repositories", query, lambda: {
+            "repositories": list(iter_repositories(
+                *self._common(), query.get('organization'),
+                query.get('visibility'), query.get('next_page'), limit,
+                self.max_pages))})
+
+    def robots(self, query, body):
+        organization, = _required(query, 'organization')
+        return self._listing("robots", query, lambda: (
+            get_robots_in_organization(*self._common(), organization)))
+
+    def prototypes(self, query, body):
+        organization, = _required(query, 'organization')
+        return self._listing("prototypes", query, lambda: (
+            get_prototypes_in_org(*self._common(), organization)))
+
+    def teams(self, query, body):
+        organization, = _required(query, 'organization')
+        return self._listing("teams", query, lambda: {"teams": sorted(
+            get_organization_teams(*self._common(), organization))})
+
+    def tags(self, query, body):
+        organization, repository = _required(query, 'organization',
+                                             'repository')
+        return self._listing("tags", query, lambda: {"tags": list(
+            iter_repository_tags(
+                *self._common(), organization, {"name": repository},
+                specific_tag=query.get('tag'),
+                only_active=query.get('active') == "true"))})
+
+    def images(self, query, body):
+        organization, repository = _required(query, 'organization',
+                                             'repository')
+        return self._listing("images", query, lambda: {"images": list(
+            iter_repository_images(*self._common(), [repository],
+                                   organization))})
+
+    def operations(self, query, body):
+        """Run batch operations, given as a list or a single one.
+
+        Consecutive operations of the same kind run in parallel, like
+        with --batch.
+        """
+        items = body if isinstance(body, list) else [body]
+        self._expire_states()
+        run = functools.partial(run_operation, *self._common(), self.states,
+                                self.states_lock)
+        results = []
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(self.jobs, 1)) as executor:
+            for _, group in itertools.groupby(
+                    items, key=lambda item: isinstance(item, dict) and
+                    item.get('op')):
+                results.extend(executor.map(run, group))
+
+        for item, result in zip(items, results):
+            # NOTE: a failed operation may have changed Quay anyway.
+            if isinstance(item, dict) and item.get('organization') and (
+                    result['status'] != "ok" or
+                    item.get('op') == "create-organization"):
+                self.invalidate(item.get('organization'))
+        return {"results": results}
+
+    def _bulk(self, body, func, get_args):
+        organization, = _required(body, 'organization')
+        repos = iter_organization_repositories(
+            *self._common(), organization, body.get('repositories'),
+            body.get('skip_repo'), self.max_pages)
+        failures = func(*self._common(), *get_args(organization, repos),
+                        jobs=self.jobs, fail_fast=self.fail_fast) or []
+        return {"status": "failed" if failures else "ok",
+                "failures": [{"repository": name, "error": str(error)}
+                             for name, error in failures]}
+
+    def set_visibility(self, query, body):
+        visibility, = _required(body, 'visibility')
+        if visibility not in ("public", "private"):
+            raise server.ApiError(400, "visibility is public or private")
+        return self._bulk(body, functools.partial(
+            make_visibility, force=bool(body.get('force'))),
+            lambda organization, repos: (repos, visibility))
+
+    def set_permissions(self, query, body):
+        user, = _required(body, 'user')
+        return self._bulk(body, functools.partial(
+            set_user_repo_permissions, force=bool(body.get('force'))),
+            lambda organization, repos: (repos, organization, user))
+
+    def expire(self, query, body):
+        tag, = _required(body, 'tag')
+        days = body.get('days')
+        if not isinstance(days, int) or days < 0:
+            raise server.ApiError(400, "days is a number of days, 0 to "
+                                       "remove the expiration")
+        return self._bulk(body, functools.partial(
+            expire_tag, force=bool(body.get('force'))),
+            lambda organization, repos: (organization, tag, repos, days))
+
+    def restore_tag(self, query, body):
+        tag, = _required(body, 'tag')
+        return self._bulk(body, restore_tag, lambda organization, repos: (
+            organization, tag, repos))
+
+    def invalidate_state(self, query, body):
+        self.invalidate(body.get('organization'))
+        return {"status": "ok"}
+
+    def routes(self):
+        routes = {
+            ("GET", "/health"): self.health,
+            ("GET", "/repositories"): self.repositories,
+            ("GET", "/robots"): self.robots,
+            ("GET", "/prototypes"): self.prototypes,
+            ("GET", "/teams"): self.teams,
+            ("GET", "/tags"): self.tags,
+            ("GET", "/images"): self.images,
+            ("POST", "/operations"): self.operations,
+            ("POST", "/set-visibility"): self.set_visibility,
+            ("POST", "/set-permissions"): self.set_permissions,
+            ("POST", "/expire"): self.expire,
+            ("POST", "/restore-tag"): self.restore_tag,
+            ("POST", "/invalidate"): self.invalidate_state,
+        }
+        return {route: _quay_errors(func) for route, func in routes.items()}
+
+
+def _quay_errors(func):
+    """Answer with the status of Quay when it refused the request."""
+    @functools.wraps(func)
+    def wrapper(query, body):
+        try:
+            return func(query, body)
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code if e.response is not None else 0
+            raise server.ApiError(status if 400 <= status < 500 else 502,
+                                  str(e))
+        except requests.exceptions.RequestException as e:
+            raise server.ApiError(502, str(e))
+    return wrapper
+
+
+def serve(api_url, headers, insecure, listen, secret_file,
+          jobs=DEFAULT_JOBS, fail_fast=False, max_pages=None):
+    try:
+        secret = server.load_secret(secret_file)
+    except OSError as e:
+        print("Can not continue: can not read the secret: %s" % e)
+        sys.exit(1)
+    if not secret:
+        print("Can not continue: %s is empty" % secret_file)
+        sys.exit(1)
+    if listen == DEFAULT_LISTEN:
+        os.makedirs(cache.DEFAULT_CACHE_DIR, mode=0o700, exist_ok=True)
+
+    service = Service(api_url, headers, insecure, jobs, fail_fast, max_pages)
+    httpd = server.make_server(listen, service.routes(), secret)
+    logging.info("Serving the Quay API %s on %s, the clients must send the "
+                 "secret of %s", api_url, listen, secret_file)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
+def get_retention_policy(args):
+    if not args.keep_last and args.older_than is None:
+        print("Can not continue: --retention needs --keep-last or "
+              "--older-than")
+        sys.exit(1)
+    if args.grace_days < 1:
+        print("Can not continue: --grace-days must be at least 1")
+        sys.exit(1)
+    try:
+        return retention.RetentionPolicy(args.tag_pattern, args.tag_glob,
+                                         args.keep_last, args.older_than,
+                                         args.grace_days)
+    except re.error as e:
+        print("Can not continue: invalid --tag-pattern: %s" % e)
+        sys.exit(1)
+
+
+def get_bulk_action(args):
+    """Return the name of the bulk action asked by args, if any."""
+    if args.set_visibility:
+        return "set-visibility %s" % args.visibility
+    if args.set_permissions:
+        return "set-permissions %s" % args.user
+    if args.restore_tag:
+        return "restore-tag %s" % args.tag
+    if args.retention:
+        return "retention %s" % get_retention_policy(args).describe()
+    if args.expire is not None:
+        return "expire %s %s" % (args.tag, args.expire)
+
+
+def plan_bulk_action(args, organization, repos, stream=None):
+    """Write to stream the repositories that the bulk action of args would
+    change.
+
+    Nothing is sent, the repositories are not marked as done in the job.
+    """
+    if args.set_permissions and not args.user:
+        print("Can not continue. You need to provide --organization "
+              "and --user parameters")
+        return
+
+    unchanged = []
+    if args.set_visibility and not args.force:
+        repos = _filter_visibility(repos, args.visibility, unchanged)
+    action = get_bulk_action(args)
+    output.write_records(({"organization": organization,
+                           "repository": repo['name'], "action": action}
+                          for repo in repos),
+                         args.output or "table", args.fields, stream)
+    report_unchanged(len(unchanged),
+                     "repositories already %s" % args.visibility)
+    return []
+
+
+def run_bulk_action(args, api_url, headers, insecure, organization, repos,
+                    job, jobs, stream=None):
+    if args.dry_run and not args.retention:
+        return plan_bulk_action(args, organization, repos, stream)
+    if args.set_visibility:
+        return make_visibility(api_url, headers, insecure, repos,
+                               args.visibility, jobs, args.fail_fast, job,
+                               args.force)
+    if args.set_permissions:
+        return set_user_repo_permissions(api_url, headers, insecure, repos,
+                                         organization, args.user, jobs,
+                                         args.fail_fast, job, args.force)
+    if args.restore_tag:
+        return restore_tag(api_url, headers, insecure, organization,
+                           args.tag, repos, jobs, args.fail_fast, job)
+    if args.retention:
+        return apply_retention(api_url, headers, insecure, organization,
+                               repos, get_retention_policy(args), jobs,
+                               args.fail_fast, job, args.dry_run,
+                               args.output, args.fields, stream)
+    return expire_tag(api_url, headers, insecure, organization, args.tag,
+                      repos, args.expire, jobs, args.fail_fast, job,
+                      args.force)
+
+
+def get_changes(args, api_url, headers, insecure, organization, action):
+    """Return the ChangeFilter of --since for the organization, if any."""
+    if args.since is None:
+        return
+    key = marks.get_key(api_url, organization, action)
+    partial = bool(args.repository or args.skip_repo or args.max_pages)
+    since = args.since
+    if since == marks.LAST_RUN:
+        since = marks.HighWaterMarks().get(key)
+        if since is None:
+            print("No earlier run of %s on %s, working on every repository"
+                  % (action, organization))
+            return marks.ChangeFilter(key, partial=partial)
+    print("Working on the repositories of %s changed since %s" % (
+        organization, marks.format_time(since)))
+    names = None
+    if args.since_source == "logs":
+        names = set(iter_changed_repositories(api_url, headers, insecure,
+                                              organization, since))
+    return marks.ChangeFilter(key, since, names, partial)
+
+
+def save_changes(changes, failures, dry_run=False):
+    """Keep the high-water mark of a successful run over the whole
+    organization.
+
+    A dry run changed nothing, the next run must still see the changes.
+    """
+    if not changes:
+        return
+    if changes.skipped:
+        print("Skipped %s repositories not changed since %s" % (
+            changes.skipped, marks.format_time(changes.since)))
+    if changes.partial:
+        print("Not saving the high-water mark: --repository, --skip-repo "
+              "or --max-pages only listed part of the organization")
+    elif changes.newest and not failures and not dry_run:
+        marks.HighWaterMarks().set(changes.key, changes.newest)
+
+
+def start_job(args, headers, action, target=None, job_id=None,
+              changes=None):
+    """Return the journal of the bulk job and the repositories to work on.
+
+    A resumed job reuses the repository list saved by its first run. The
+    job of a fan-out target is named after job_id and the target. With
+    changes, only the changed repositories are worked on.
+    """
+    api_url, insecure = args.api_url, args.insecure
+    organization = args.organization
+    job_id = job_id or args.resume
+    resume = bool(args.resume)
+    if target:
+        api_url, insecure = target['api_url'], target['insecure']
+        organization = target['organization']
+        job_id = "%s.%s" % (job_id, re.sub(r"[^\w-]", "_", "%s.%s" % (
+            target['name'], organization)))
+        # NOTE: the run may have stopped before starting this target.
+        resume = resume and journal.job_exists(job_id)
+
+    action = "%s on %s" % (action, organization)
+    try:
+        job = journal.Journal(action, job_id, resume=resume)
+    except (journal.JournalError, OSError) as e:
+        print("Can not continue: %s" % e)
+        sys.exit(1)
+    if not target:
+        print("Job %s: to resume it, use --resume %s" % (job.job_id,
+                                                         job.job_id))
+
+    repos = job.load_repositories()
+    if repos is not None:
+        print("Reusing the %s repositories listed by the job" % len(repos))
+        return job, repos
+
+    repos = iter_organization_repositories(
+        api_url, headers, insecure, organization, args.repository,
+        args.skip_repo, args.max_pages, last_modified=bool(changes))
+    if changes:
+        repos = changes.filter(repos)
+    return job, job.track_repositories(repos)
+
+
+def finish_job(job, failures, dry_run=False):
+    """Close the journal of the job, and delete the job when it has nothing
+    left to resume: it ended without failures, or was a dry run.
+    """
+    if failures and not dry_run:
+        job.close()
+    else:
+        job.remove()
+
+
+def setup_stats(print_summary=True, path=None, interval=None):
+    """Record the request stats, reported at exit.
+
+    With interval, the stats file is also written every interval seconds,
+    for the daemon mode that does not exit.
+    """
+    request_stats = stats.RequestStats()
+    add_request_hook(request_stats.record)
+
+    def write_stats():
+        if print_summary:
+            request_stats.print_summary()
+        if path:
+            request_stats.write(path)
+
+    def write_periodically():
+        while True:
+            time.sleep(interval)
+            try:
+                request_stats.write(path)
+            except OSError as e:
+                logging.warning("Can not write the stats to %s: %s", path, e)
+
+    if path and interval:
+        threading.Thread(target=write_periodically, daemon=True).start()
+    atexit.register(write_stats)
+    return request_stats
 
 
 def setup_logging(debug):
@@ -578,53 +2672,152 @@ def main():
     args = get_args()
     setup_logging(args.debug)
 
-    if (not args.token and args.visibility or not args.token
-            and args.list_images):
+    if not args.token and not args.registries and (args.visibility or
+                                                   args.list_images):
         print("Can not continue: --token argument is required!")
         sys.exit(1)
 
-    if not args.insecure:
-        requests.packages.urllib3.disable_warnings()
-
-    headers = gen_headers(args.token)
+    if not args.api_url and not args.registries:
+        print("Can not continue: --api-url or --registries is required!")
+        sys.exit(1)
 
-    if '/api/v' not in args.api_url:
+    if args.api_url and '/api/v' not in args.api_url:
         print("Please add to the --api-url API endpoint!")
         sys.exit(1)
 
+    if args.dry_run and (args.serve or args.create_organization or
+                         args.create_robot or args.regenerate_token or
+                         args.create_team or args.add_member or
+                         args.create_prototype):
+        print("Can not continue: --dry-run only works with --apply, --batch, "
+              "--create-repository, --set-visibility, --set-permissions, "
+              "--expire, --restore-tag, --retention and --rotate-tokens")
+        sys.exit(1)
+
+    headers = gen_headers(args.token)
+    registries = None
+    if args.registries:
+        registries = load_registries(args.registries, args)
+
+    # NOTE: keep a pooled connection available for every bulk worker. The
+    # token of the command line must not be sent to the other registries.
+    setup_session(headers if args.token and not registries else None,
+                  args.insecure, max([args.pool_size, args.jobs] + [
+                      registry['jobs'] for registry in registries or []]))
+    setup_scheduler(args.max_rps, args.jobs, args.retries)
+    for registry in registries or []:
+        setup_scheduler(registry['max_rps'], registry['jobs'], args.retries,
+                        registry['api_url'])
+    if args.stats or args.stats_file:
+        setup_stats(args.stats, args.stats_file,
+                    STATS_INTERVAL if args.serve else None)
+    if not args.no_cache:
+        setup_cache(args.refresh)
+
     if args.info:
         get_quay_info(args.api_url, args.insecure)
         exit(0)
 
-    if args.list_images:
+    patterns = split_organizations(args.organization)
+    if not registries and (len(patterns) > 1 or args.rotate_tokens or any(
+            is_pattern(pattern) for pattern in patterns)):
+        if args.rotate_tokens and not patterns:
+            print("Can not continue: --organization or --registries is "
+                  "required!")
+            sys.exit(1)
+        registries = [{
+            "name": urllib.parse.urlparse(args.api_url).netloc,
+            "api_url": args.api_url, "headers": headers,
+            "insecure": args.insecure, "organizations": patterns,
+            "jobs": args.jobs}]
+
+    failures = None
+    if registries:
+        targets = get_targets(registries, patterns)
+        if args.rotate_tokens:
+            failures = rotate_tokens(args, targets)
+        elif get_bulk_action(args):
+            failures = fan_out_bulk_action(args, targets)
+        elif args.list_repositories:
+            failures = fan_out_listing(args, targets)
+        else:
+            print("Can not continue: only --set-visibility, "
+                  "--set-permissions, --expire, --restore-tag, --retention, "
+                  "--rotate-tokens and --list-repositories work on several "
+                  "organizations")
+            sys.exit(1)
+    elif args.serve:
+        serve(args.api_url, headers, args.insecure, args.listen,
+              args.serve_secret_file, args.jobs, args.fail_fast,
+              args.max_pages)
+    elif args.batch:
+        failures = run_batch(args.api_url, headers, args.insecure, args.batch,
+                             args.jobs, args.dry_run)
+    elif args.apply:
+        failures = apply_state(args.api_url, headers, args.insecure,
+                               args.organization, args.apply, args.jobs,
+                               args.fail_fast, args.dry_run)
+    elif args.list_images and args.output:
+        if not args.repository:
+            print("Can not continue. You need to provide --repository option")
+            sys.exit(1)
+        output.write_records(
+            iter_repository_images(args.api_url, headers, args.insecure,
+                                   args.repository, args.organization),
+            args.output, args.fields)
+    elif args.list_images:
         get_repository_images(args.api_url, headers, args.insecure,
                               args.repository, args.organization)
-    elif args.set_visibility:
-        repos = get_organization_details(args.api_url, headers, args.insecure,
-                                         args.organization, args.repository,
-                                         args.skip_repo)
-        make_visibility(args.api_url, headers, args.insecure, repos,
-                        args.visibility)
-    elif args.set_permissions:
-        repos = get_organization_details(args.api_url, headers, args.insecure,
-                                         args.organization, args.repository,
-                                         args.skip_repo)
-        set_user_repo_permissions(args.api_url, headers, args.insecure, repos,
-                                  args.organization, args.user)
+    elif get_bulk_action(args):
+        action = get_bulk_action(args)
+        # NOTE: a dry run writes records, keep the messages out of them.
+        records = sys.stdout
+        messages = sys.stderr if args.dry_run else sys.stdout
+        with contextlib.redirect_stdout(messages):
+            changes = get_changes(args, args.api_url, headers, args.insecure,
+                                  args.organization, action)
+            job, repos = start_job(args, headers, action, changes=changes)
+            with contextlib.closing(job):
+                failures = run_bulk_action(args, args.api_url, headers,
+                                           args.insecure, args.organization,
+                                           repos, job, args.jobs, records)
+            finish_job(job, failures, args.dry_run)
+            save_changes(changes, failures, args.dry_run)
+    elif args.storage_report:
+        failures = report_storage(
+            args.api_url, headers, args.insecure, args.organization,
+            iter_organization_repositories(
+                args.api_url, headers, args.insecure, args.organization,
+                args.repository, args.skip_repo, args.max_pages),
+            args.jobs, args.fail_fast, args.top, args.output, args.fields)
+    elif args.audit_permissions:
+        failures = audit_permissions(
+            args.api_url, headers, args.insecure, args.organization,
+            iter_organization_repositories(
+                args.api_url, headers, args.insecure, args.organization,
+                args.repository, args.skip_repo, args.max_pages),
+            args.jobs, args.fail_fast, args.output, args.fields)
     elif args.create_repository:
-        create_repository(args.api_url, headers, args.insecure,
-                          args.organization, args.repository)
+        repositories = [{"name": name, "visibility": args.visibility}
+                        for name in args.repository]
+        if args.manifest:
+            repositories += load_repository_manifest(args.manifest,
+                                                     args.visibility)
+        failures = create_repository(args.api_url, headers, args.insecure,
+                                     args.organization, repositories,
+                                     args.jobs, args.fail_fast,
+                                     dry_run=args.dry_run)
     elif args.create_organization:
         create_organization(args.api_url, headers, args.insecure,
                             args.organization)
     elif args.list_robots:
         robots = get_robots_in_organization(args.api_url, headers,
                                             args.insecure, args.organization)
-        print(robots)
+        print_listing(robots, 'robots', args.output, args.fields)
     elif args.list_prototypes:
         prototypes = get_prototypes_in_org(args.api_url, headers,
                                            args.insecure, args.organization)
-        print(prototypes)
+        print_listing(prototypes, 'prototypes', args.output, args.fields)
     elif args.create_prototype:
         prototypes = create_prototype_in_org(args.api_url, headers,
                                              args.insecure, args.organization,
@@ -643,22 +2836,20 @@ def main():
     elif args.add_member:
         add_member(args.api_url, headers, args.insecure, args.organization,
                    args.team, args.user)
+    elif args.list_repositories and args.output:
+        output.write_records(
+            iter_repositories(args.api_url, headers, args.insecure,
+                              args.organization, args.visibility,
+                              args.next_page, args.limit, args.max_pages),
+            args.output, args.fields)
     elif args.list_repositories:
         repos = list_repositories(args.api_url, headers, args.insecure,
-                                  args.organization, args.visibility)
-        print(repos)
-    elif args.restore_tag:
-        repos = get_organization_details(args.api_url, headers, args.insecure,
-                                         args.organization, args.repository,
-                                         args.skip_repo)
-        restore_tag(args.api_url, headers, args.insecure, args.organization,
-                    args.tag, repos)
-    elif args.expire or args.expire == 0:
-        repos = get_organization_details(args.api_url, headers, args.insecure,
-                                         args.organization, args.repository,
-                                         args.skip_repo)
-        expire_tag(args.api_url, headers, args.insecure, args.organization,
-                   args.tag, repos, args.expire)
+                                  args.organization, args.visibility,
+                                  args.next_page, args.limit, args.max_pages)
+        print_listing(repos, 'repositories', args.output, args.fields)
+
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,93 @@
+# Copyright 2022, Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fnmatch
+import re
+import time
+
+DAY = 24 * 60 * 60
+
+
+class RetentionPolicy:
+    """Which tags of a repository to expire.
+
+    The tags matching one of the regex patterns or globs (every tag when
+    there are none) are candidates. The keep_last newest candidates and the
+    ones younger than older_than days are kept, the others get expired in
+    grace_days.
+    """
+
+    def __init__(self, patterns=None, globs=None, keep_last=None,
+                 older_than=None, grace_days=1):
+        self.selectors = list(patterns or []) + list(globs or [])
+        self.patterns = [re.compile(pattern) for pattern in patterns or []]
+        self.patterns += [re.compile(fnmatch.translate(glob))
+                          for glob in globs or []]
+        self.keep_last = keep_last or 0
+        self.older_than = older_than
+        self.grace_days = grace_days
+
+    def describe(self):
+        rules = []
+        if self.selectors:
+            rules.append("tags matching %s" % " or ".join(self.selectors))
+        if self.keep_last:
+            rules.append("keep last %s" % self.keep_last)
+        if self.older_than is not None:
+            rules.append("older than %s days" % self.older_than)
+        return ", ".join(rules)
+
+    def matches(self, name):
+        return not self.patterns or any(pattern.search(name)
+                                        for pattern in self.patterns)
+
+    def plan(self, tags, now=None):
+        """Return the tags to expire and the digests of the kept tags.
+
+        tags are the active tags of a repository, in any order. The tags
+        already expiring before the deadline of the policy are left as is.
+        """
+        now = now or time.time()
+        deadline = now + self.grace_days * DAY
+        candidates = []
+        kept_digests = set()
+        for tag in tags:
+            if self.matches(tag['name']):
+                candidates.append(tag)
+            else:
+                kept_digests.add(tag.get('manifest_digest'))
+
+        candidates.sort(key=lambda tag: tag.get('start_ts') or 0,
+                        reverse=True)
+        expire = []
+        for index, tag in enumerate(candidates):
+            young = self.older_than is not None and (
+                now - (tag.get('start_ts') or now) < self.older_than * DAY)
+            if index < self.keep_last or young:
+                kept_digests.add(tag.get('manifest_digest'))
+                continue
+            end_ts = tag.get('end_ts')
+            if end_ts and end_ts <= deadline:
+                continue
+            expire.append(tag)
+        return expire, kept_digests
+
+
+def get_reclaimed(expire, kept_digests):
+    """Return the size of the manifests only referenced by expired tags,
+    by digest.
+    """
+    return {tag.get('manifest_digest'): tag.get('size') or 0
+            for tag in expire
+            if tag.get('manifest_digest') not in kept_digests}
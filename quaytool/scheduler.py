@@ -0,0 +1,184 @@
+# Copyright 2022, Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import logging
+import random
+import re
+import threading
+import time
+
+from quaytool import lazy
+
+# NOTE: loaded on first use, see lazy.lazy_import
+email_utils = lazy.lazy_import("email.utils")
+requests = lazy.lazy_import("requests")
+
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 0.5
+MAX_BACKOFF = 60
+RETRY_STATUSES = (429, 502, 503, 504)
+PRESSURE_STATUSES = (429, 503)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+# POST endpoints that can be sent again without changing the result.
+IDEMPOTENT_POSTS = re.compile(r"/changevisibility$")
+
+
+def get_retry_after(response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = email_utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max((date - now).total_seconds(), 0)
+
+
+def is_idempotent(method, url):
+    return (method in IDEMPOTENT_METHODS or
+            bool(IDEMPOTENT_POSTS.search(url.split('?', 1)[0])))
+
+
+class TokenBucket:
+    """Client side rate limit of rate requests per second."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimiter:
+    """Limit of requests in flight that shrinks when Quay is under pressure.
+
+    The limit is halved on every 429 or 503 answer and grows back by one
+    after each run of limit successful requests.
+    """
+
+    def __init__(self, max_limit):
+        self.max_limit = max(max_limit, 1)
+        self.limit = self.max_limit
+        self.in_flight = 0
+        self.successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, pressure=False):
+        with self._cond:
+            self.in_flight -= 1
+            if pressure:
+                self.successes = 0
+                if self.limit > 1:
+                    self.limit = max(self.limit // 2, 1)
+                    logging.debug("Quay is under pressure, lowering the "
+                                  "concurrency to %s", self.limit)
+            else:
+                self.successes += 1
+                if (self.successes >= self.limit and
+                        self.limit < self.max_limit):
+                    self.successes = 0
+                    self.limit += 1
+            self._cond.notify_all()
+
+
+class RequestScheduler:
+    """Send the API requests with rate limiting and retries.
+
+    Requests that failed with a 429 or 5xx gateway error, or a connection
+    error, are sent again with a jittered exponential backoff that honours
+    the Retry-After header. Only idempotent requests are retried, except on
+    429 where Quay did not process the request.
+    """
+
+    def __init__(self, max_rps=None, max_concurrency=None,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+        self.bucket = TokenBucket(max_rps) if max_rps else None
+        self.limiter = (AdaptiveLimiter(max_concurrency)
+                        if max_concurrency else None)
+        self.retries = retries
+        self.backoff = backoff
+
+    def _delay(self, attempt, response=None):
+        retry_after = (get_retry_after(response)
+                       if response is not None else None)
+        if retry_after is not None:
+            return min(retry_after, MAX_BACKOFF)
+        delay = min(self.backoff * 2 ** attempt, MAX_BACKOFF)
+        return random.uniform(delay / 2, delay)
+
+    def _send_once(self, send):
+        if self.bucket:
+            self.bucket.acquire()
+        if self.limiter:
+            self.limiter.acquire()
+        response = None
+        try:
+            response = send()
+            return response
+        finally:
+            if self.limiter:
+                self.limiter.release(
+                    response is not None and
+                    response.status_code in PRESSURE_STATUSES)
+
+    def send(self, method, url, send):
+        """Call send() until it gives a final response."""
+        idempotent = is_idempotent(method, url)
+        attempt = 0
+        while True:
+            try:
+                response = self._send_once(send)
+            except requests.exceptions.ConnectionError:
+                if not idempotent or attempt >= self.retries:
+                    raise
+                delay = self._delay(attempt)
+                logging.warning("Connection error on %s %s, retrying in "
+                                "%.1fs", method, url, delay)
+            else:
+                status = response.status_code
+                if (status not in RETRY_STATUSES or attempt >= self.retries
+                        or not (idempotent or status == 429)):
+                    return response
+                delay = self._delay(attempt, response)
+                response.close()
+                logging.warning("Got %s on %s %s, retrying in %.1fs",
+                                status, method, url, delay)
+            attempt += 1
+            time.sleep(delay)
@@ -0,0 +1,240 @@
+# Copyright 2022, Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import hmac
+import http.server
+import json
+import logging
+import os
+import secrets
+import socket
+import socketserver
+import stat
+import threading
+import urllib.parse
+
+MAX_BODY_SIZE = 16 * 1024 * 1024
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+
+def load_secret(path):
+    """Return the secret of the clients, kept in path.
+
+    A new random secret is written in path when it does not exist, only
+    readable by its owner.
+    """
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    secret = secrets.token_urlsafe(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(secret + "\n")
+    return secret
+
+
+def get_host(header):
+    """Return the host name of a Host header, without the port."""
+    if header.startswith("["):
+        return header[1:].partition("]")[0]
+    return header.rpartition(":")[0] if header.count(":") == 1 else header
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Coalescer:
+    """Share the result of a call between the callers asking at same time.
+
+    The first caller of a key runs the function, the ones coming while it
+    runs wait for it and get the same result or exception. Nothing is kept
+    once the call is done.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event()}
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                          http.server.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        self._remove_stale_socket()
+        # NOTE: only the owner of the daemon may use its token.
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+    def _remove_stale_socket(self):
+        """Remove the socket left by a daemon that did not stop cleanly."""
+        try:
+            if not stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+                return
+        except FileNotFoundError:
+            return
+        with socket.socket(socket.AF_UNIX) as client:
+            try:
+                client.connect(self.server_address)
+            except OSError as e:
+                if e.errno == errno.ECONNREFUSED:
+                    os.unlink(self.server_address)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class JsonHandler(http.server.BaseHTTPRequestHandler):
+    """Dispatch JSON requests to the routes of the server.
+
+    server.routes maps (method, path) to a function called with the query
+    parameters and the decoded body, that returns the JSON answer. Every
+    request needs the server.secret as bearer token, bodies must be JSON
+    and, on TCP, the Host must be one of server.allowed_hosts: browsers
+    can not send such requests from another site.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # NOTE: clients of a unix socket have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, fmt, *args):
+        logging.info("%s %s", self.address_string(), fmt % args)
+
+    def _reply(self, status, data):
+        content = (json.dumps(data, default=str) + "\n").encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _check_client(self):
+        allowed_hosts = getattr(self.server, "allowed_hosts", None)
+        if allowed_hosts and get_host(
+                self.headers.get("Host") or "") not in allowed_hosts:
+            raise ApiError(403, "Unexpected Host header")
+        scheme, _, secret = (self.headers.get("Authorization") or
+                             "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(
+                secret.strip().encode(), self.server.secret.encode()):
+            raise ApiError(401, "Missing or wrong bearer token")
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY_SIZE:
+            raise ApiError(413, "Request body is too large")
+        if not length and self.command == "GET":
+            return {}
+        content_type = (self.headers.get("Content-Type") or "").partition(
+            ";")[0].strip().lower()
+        if content_type != "application/json":
+            raise ApiError(415, "Request body must be application/json")
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            raise ApiError(400, "Request body is not valid JSON")
+
+    def _handle(self):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            self._check_client()
+            body = self._read_body()
+            route = self.server.routes.get((self.command,
+                                            url.path.rstrip("/") or "/"))
+            if not route:
+                raise ApiError(404, "Unknown endpoint %s %s" % (
+                    self.command, url.path))
+            self._reply(200, route(query, body))
+        except ApiError as e:
+            # NOTE: the body was not read, the connection can not be reused.
+            self.close_connection = True
+            self._reply(e.status, {"error": str(e)})
+        except SystemExit:
+            # NOTE: the CLI functions exit on some missing resources
+            self._reply(400, {"error": "Operation aborted, see the server "
+                                       "log"})
+        except Exception as e:
+            logging.exception("Failed to handle %s %s", self.command,
+                              self.path)
+            self._reply(500, {"error": str(e)})
+
+    do_GET = do_POST = _handle
+
+
+def make_server(listen, routes, secret):
+    """Return a threaded HTTP server for routes.
+
+    listen is a host:port, or unix:PATH for a unix socket. The clients
+    must send secret as bearer token.
+    """
+    if listen.startswith("unix:"):
+        server = ThreadingUnixHTTPServer(listen[len("unix:"):], JsonHandler)
+        server.allowed_hosts = None
+    else:
+        host, _, port = listen.rpartition(":")
+        host = host.strip("[]") or "127.0.0.1"
+        server = ThreadingHTTPServer((host, int(port)), JsonHandler)
+        # NOTE: refuse the names of other sites resolved to this address
+        server.allowed_hosts = set(LOCAL_HOSTS) | {host}
+    server.routes = routes
+    server.secret = secret
+    return server
@@ -0,0 +1,220 @@
+# Copyright 2022, Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import collections
+import json
+import os
+import sys
+import threading
+import urllib.parse
+
+PERCENTILES = (50, 95, 99)
+# Upper bounds in seconds of the latency histogram buckets, the last one
+# catches everything.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5,
+                   0.75, 1, 2.5, 5, 10, float("inf"))
+# Path segments that are followed by a name, replaced in endpoint templates.
+NAMED_SEGMENTS = {
+    "organization": "{organization}",
+    "team": "{team}",
+    "robots": "{robot}",
+    "tag": "{tag}",
+    "members": "{member}",
+    "user": "{user}",
+    "prototypes": "{prototype}",
+}
+
+
+def endpoint_template(method, url):
+    """Return the endpoint of the url without names, like
+    GET /repository/{namespace}/{repository}/tag/
+    """
+    path = urllib.parse.urlparse(url).path
+    prefix, sep, path = path.partition("/api/v1")
+    if not sep:
+        path = prefix
+    parts = path.strip("/").split("/")
+    template = []
+    index = 0
+    while index < len(parts):
+        part = parts[index]
+        template.append(part)
+        if part == "repository" and index == 0 and len(parts) > 2:
+            template += ["{namespace}", "{repository}"]
+            index += 3
+            continue
+        if part in NAMED_SEGMENTS and index + 1 < len(parts) and parts[
+                index + 1]:
+            template.append(NAMED_SEGMENTS[part])
+            index += 2
+            continue
+        index += 1
+    return "%s /%s" % (method, "/".join(template))
+
+
+def percentile(buckets, percent):
+    """Estimate a percentile from the counts of the LATENCY_BUCKETS, with a
+    linear interpolation inside the bucket, like Prometheus does.
+    """
+    total = sum(buckets)
+    if not total:
+        return 0
+    rank = percent / 100 * total
+    seen = 0
+    lower = 0
+    for upper, count in zip(LATENCY_BUCKETS, buckets):
+        if count and seen + count >= rank:
+            if upper == float("inf"):
+                return lower
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+        lower = upper
+    return lower
+
+
+class EndpointStats:
+    def __init__(self):
+        self.count = 0
+        self.retries = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.statuses = collections.Counter()
+        self.latency_sum = 0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+
+    def add_latency(self, elapsed):
+        self.latency_sum += elapsed
+        self.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS,
+                                                elapsed)] += 1
+
+    def to_dict(self):
+        result = {
+            "count": self.count,
+            "retries": self.retries,
+            "errors": self.errors,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "statuses": {str(k): v for k, v in sorted(self.statuses.items())},
+            "latency_sum": self.latency_sum,
+            "latency_buckets": list(self.latency_buckets),
+        }
+        for percent in PERCENTILES:
+            result["latency_p%s" % percent] = percentile(
+                self.latency_buckets, percent)
+        return result
+
+
+class RequestStats:
+    """Per endpoint accounting of the requests sent to Quay.
+
+    record() is meant to be used as a request hook: it only updates
+    in-memory counters and a fixed latency histogram, so the memory does
+    not grow with the requests. The percentiles are estimated when
+    reporting.
+    """
+
+    def __init__(self):
+        self.endpoints = collections.defaultdict(EndpointStats)
+        self._lock = threading.Lock()
+
+    def record(self, method, url, response=None, error=None, elapsed=0,
+               attempt=0):
+        endpoint = endpoint_template(method, url)
+        with self._lock:
+            stats = self.endpoints[endpoint]
+            stats.count += 1
+            stats.add_latency(elapsed)
+            if attempt:
+                stats.retries += 1
+            if error is not None:
+                stats.errors += 1
+            if response is not None:
+                stats.statuses[response.status_code] += 1
+                stats.bytes_sent += len(response.request.body or b"")
+                stats.bytes_received += len(response.content or b"")
+
+    def to_dict(self):
+        with self._lock:
+            return {endpoint: stats.to_dict()
+                    for endpoint, stats in sorted(self.endpoints.items())}
+
+    def print_summary(self, stream=None):
+        stream = stream or sys.stderr
+        data = self.to_dict()
+        stream.write("%-60s %6s %5s %10s %8s %8s %8s\n" % (
+            "ENDPOINT", "COUNT", "RETRY", "BYTES", "P50", "P95", "P99"))
+        for endpoint, stats in data.items():
+            stream.write("%-60s %6s %5s %10s %7.0fms %7.0fms %7.0fms\n" % (
+                endpoint, stats['count'], stats['retries'],
+                stats['bytes_received'], stats['latency_p50'] * 1000,
+                stats['latency_p95'] * 1000, stats['latency_p99'] * 1000))
+
+    def to_prometheus(self):
+        data = self.to_dict()
+        lines = []
+
+        def header(name, kind, help_text):
+            lines.append("# HELP quaytool_%s %s" % (name, help_text))
+            lines.append("# TYPE quaytool_%s %s" % (name, kind))
+
+        def sample(name, value, **labels):
+            lines.append("quaytool_%s{%s} %s" % (name, ",".join(
+                '%s="%s"' % (key, labels[key]) for key in sorted(labels)),
+                value))
+
+        header("requests_total", "counter", "Requests sent to Quay")
+        for endpoint, stats in data.items():
+            for status, count in stats['statuses'].items():
+                sample("requests_total", count, endpoint=endpoint,
+                       status=status)
+
+        for name, key, help_text in (
+                ("request_retries_total", "retries", "Retried requests"),
+                ("request_errors_total", "errors",
+                 "Requests that got no response"),
+                ("response_bytes_total", "bytes_received",
+                 "Bytes received from Quay")):
+            header(name, "counter", help_text)
+            for endpoint, stats in data.items():
+                sample(name, stats[key], endpoint=endpoint)
+
+        header("request_duration_seconds", "histogram",
+               "Latency of the requests sent to Quay")
+        for endpoint, stats in data.items():
+            cumulative = 0
+            for upper, count in zip(LATENCY_BUCKETS,
+                                    stats['latency_buckets']):
+                cumulative += count
+                sample("request_duration_seconds_bucket", cumulative,
+                       endpoint=endpoint,
+                       le="+Inf" if upper == float("inf") else upper)
+            sample("request_duration_seconds_sum", stats['latency_sum'],
+                   endpoint=endpoint)
+            sample("request_duration_seconds_count", stats['count'],
+                   endpoint=endpoint)
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the stats as JSON, or Prometheus text for a .prom file."""
+        if path.endswith(".prom"):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_dict(), indent=2) + "\n"
+        # NOTE: the node exporter must never read a half written file
+        tmp_path = "%s.%s.tmp" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
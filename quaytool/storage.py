@@ -0,0 +1,96 @@
+# Copyright 2022, Red Hat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import threading
+
+DEFAULT_TOP = 20
+
+
+class StorageReport:
+    """Storage used by the active tags of the repositories of organizations.
+
+    Repositories are added one at a time, their tags can be a generator.
+    The size of a manifest is only counted once per repository, whatever
+    the number of tags pointing to it, and once per organization for its
+    unique size. Only the top largest repositories and tags are kept.
+    """
+
+    def __init__(self, top=DEFAULT_TOP):
+        self.top = top
+        self.organizations = {}
+        self._repositories = []
+        self._tags = []
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def _push(self, heap, item):
+        if len(heap) < self.top:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    def add(self, organization, repository, tags):
+        digests = {}
+        largest_tags = []
+        count = 0
+        for tag in tags:
+            count += 1
+            size = tag.get('size') or 0
+            digests[tag.get('manifest_digest') or tag['name']] = size
+            self._push(largest_tags, (size, organization, repository,
+                                      tag['name']))
+        size = sum(digests.values())
+
+        with self._lock:
+            totals = self.organizations.setdefault(organization, {
+                "repositories": 0, "tags": 0, "manifests": 0, "size": 0,
+                "unique_size": 0})
+            totals['repositories'] += 1
+            totals['tags'] += count
+            totals['manifests'] += len(digests)
+            totals['size'] += size
+            seen = self._digests.setdefault(organization, set())
+            for digest, digest_size in digests.items():
+                # NOTE: a 64 bits hash instead of the digest, to keep millions
+                # of them.
+                key = hash(digest)
+                if key not in seen:
+                    seen.add(key)
+                    totals['unique_size'] += digest_size
+            self._push(self._repositories, (size, organization, repository,
+                                            count, len(digests)))
+            for item in largest_tags:
+                self._push(self._tags, item)
+
+    def records(self):
+        """Yield the organizations, then the largest repositories and tags,
+        largest first.
+        """
+        for organization, totals in sorted(self.organizations.items()):
+            yield {"kind": "organization", "organization": organization,
+                   "repository": None, "tag": None,
+                   "tags": totals['tags'], "manifests": totals['manifests'],
+                   "size": totals['size'],
+                   "unique_size": totals['unique_size']}
+        for size, organization, repository, tags, manifests in sorted(
+                self._repositories, reverse=True):
+            yield {"kind": "repository", "organization": organization,
+                   "repository": repository, "tag": None, "tags": tags,
+                   "manifests": manifests, "size": size, "unique_size": None}
+        for size, organization, repository, tag in sorted(self._tags,
+                                                          reverse=True):
+            yield {"kind": "tag", "organization": organization,
+                   "repository": repository, "tag": tag, "tags": None,
+                   "manifests": None, "size": size, "unique_size": None}